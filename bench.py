@@ -0,0 +1,583 @@
+"""
+Benchmarks for the converters, run against synthetic data:
+
+    python bench.py serializer --sizes 10000 100000 1000000
+    python bench.py compression --sizes 100000
+    python bench.py suite --sizes 10000 100000 --output results.json
+    python bench.py compare --baseline baseline.json --results results.json
+
+and the whole of walls.py against local stand-ins for Salesforce and S3:
+
+    python bench.py end-to-end --sizes 10000 100000 --backend 2.0
+
+"""
+
+import argparse
+import json
+import platform
+import sys
+import tracemalloc
+from decimal import ROUND_HALF_UP, Decimal
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+
+import walls
+from compact import compact_donors, compact_sponsors
+from config import BULK, CACHE, PIPELINE, PUBLISH, SALESFORCE
+from convert import (
+    BUSINESS_MEMBERSHIP,
+    DIGITAL_PAGES,
+    EVENT_SPONSORSHIPS,
+    LICENSING,
+    _donor_totals,
+    _extract_and_map,
+    _invert_and_aggregate,
+    _sort_circle,
+    _strip_sort_key,
+    build_sponsors,
+    json_chunks,
+    serialize_donors,
+)
+from fakes import FakeS3, FakeSalesforce
+from s3 import ENCODINGS, Publisher
+from search import donor_index
+from store import AccountCache
+
+# compression levels worth comparing for each encoding:
+LEVELS = {"gzip": [6, 9], "br": [5, 9, 11], "zstd": [3, 10, 19]}
+
+SPONSOR_RECORD_TYPES = [
+    DIGITAL_PAGES,
+    EVENT_SPONSORSHIPS,
+    BUSINESS_MEMBERSHIP,
+    LICENSING,
+]
+
+FIRST_NAMES = ["Mary", "José", "Zoë", "Ángel", "Wei", "Nguyễn", "O'Brien"]
+WEBSITES = ["", "NULL", "http://", "example.org", "http://example.org"]
+CIRCLES = ["Editor's Circle", "Chairman's Circle", "Leadership Circle"]
+STAGES = [
+    "Closed Won",
+    "Closed Won",
+    "Closed Won",
+    "Invoiced",
+    "Pledged",
+    "Closed Lost",
+]
+BUSINESS_LEVELS = ["Sponsor", "Member", "Patron"]
+
+# stages that take less than this long, or use less than this much memory,
+# are too noisy to call a regression on:
+MIN_SECONDS = 0.1
+MIN_PEAK_BYTES = 1024 * 1024
+
+
+def synthetic_donors(rows, seed=0):
+    """
+    Make opportunity and account frames shaped like the donors extract.
+    There's roughly one account for every five opportunities.
+    """
+    rng = np.random.default_rng(seed)
+    account_count = max(rows // 5, 1)
+    account_ids = np.array(["001{:012d}".format(i) for i in range(account_count)])
+
+    opportunities = DataFrame(
+        {
+            "Id": ["006{:012d}".format(i) for i in range(rows)],
+            "AccountId": account_ids[rng.integers(0, account_count, rows)],
+            "Amount": rng.choice([5.0, 10.0, 35.0, 50.0, 120.0, 1000.0], rows),
+            "CloseDate": [
+                "{}-{:02d}-15".format(year, month)
+                for year, month in zip(
+                    rng.integers(2009, 2025, rows).tolist(),
+                    rng.integers(1, 13, rows).tolist(),
+                )
+            ],
+            "RecordTypeId": rng.choice(walls.DONOR_RECORD_TYPES, rows),
+        }
+    )
+    accounts = DataFrame(
+        {
+            "AccountId": account_ids,
+            "Text_For_Donor_Wall__c": [
+                "Donor {}".format(i) for i in range(account_count)
+            ],
+        }
+    )
+    return opportunities, accounts
+
+
+def synthetic_walls(rows, seed=0):
+    """
+    Make everything the converters work from, shaped like what Salesforce
+    returns, with rows opportunities in all: sponsor and donor opportunity
+    frames, the account frame and the circle member records.
+
+    A few accounts have far more opportunities than most. Every record
+    type shows up, about a fifth of sponsor opportunities are In-Kind,
+    and about 1% of opportunities have a blank amount or no account.
+    """
+    rng = np.random.default_rng(seed)
+    account_count = max(rows // 5, 1)
+    account_ids = np.array(["001{:012d}".format(i) for i in range(account_count)])
+    # Zipf-like: the nth account is 1/n**0.8 as likely as the first
+    weights = 1 / np.arange(1, account_count + 1) ** 0.8
+    weights = weights / weights.sum()
+
+    def opportunities(count, record_types):
+        frame = DataFrame(
+            {
+                "Id": ["006{:012d}".format(i) for i in range(count)],
+                "AccountId": account_ids[rng.choice(account_count, count, p=weights)],
+                "Amount": np.round(rng.lognormal(4, 1.5, count), 2),
+                "CloseDate": pd.to_datetime(
+                    {
+                        "year": rng.integers(2009, 2026, count),
+                        "month": rng.integers(1, 13, count),
+                        "day": rng.integers(1, 29, count),
+                    }
+                ),
+                "RecordTypeId": rng.choice(record_types, count),
+            }
+        )
+        frame.loc[rng.random(count) < 0.01, "Amount"] = np.nan
+        frame.loc[rng.random(count) < 0.01, "AccountId"] = ""
+        return frame
+
+    sponsor_count = rows * 3 // 10
+    sponsors = opportunities(sponsor_count, SPONSOR_RECORD_TYPES)
+    sponsors["Type"] = np.where(rng.random(sponsor_count) < 0.2, "In-Kind", "")
+    donors = opportunities(rows - sponsor_count, walls.DONOR_RECORD_TYPES)
+
+    names = [
+        "{} {}".format(FIRST_NAMES[i % len(FIRST_NAMES)], i)
+        for i in range(account_count)
+    ]
+    accounts = DataFrame(
+        {
+            "AccountId": account_ids,
+            "Text_For_Donor_Wall__c": names,
+            "Website": rng.choice(WEBSITES, account_count),
+        }
+    )
+    circle = [
+        {
+            "Text_For_Donor_Wall__c": names[i],
+            "Name": "{} Account".format(names[i]),
+            "Membership_Level_TT__c": CIRCLES[i % len(CIRCLES)],
+        }
+        for i in range(0, account_count, 50)
+    ]
+    return sponsors, donors, accounts, circle
+
+
+def _serialize_donors_iterrows(totals, accounts_dict):
+    """
+    The row-at-a-time serializer convert_donors used to have; kept here as
+    the baseline to compare against.
+    """
+    final_list = list()
+    for accountid, new_df in totals.groupby(level=0):
+        account_dict = {"name": accounts_dict[accountid]}
+        account_dict["donations"] = list()
+        for row in new_df.iterrows():
+            year = row[0][1]
+            amount = row[1][0]
+            amount = Decimal(amount)
+            amount = amount.quantize(Decimal("1"), rounding=ROUND_HALF_UP)
+            if amount < 10:
+                amount = "Less than $10"
+            else:
+                amount = "${:,.0f}".format(amount)
+
+            donations_dict = {"year": year, "amount": "{0}".format(amount)}
+            account_dict["donations"].append(donations_dict)
+        final_list.append(account_dict)
+    return final_list
+
+
+def _time(func, *args):
+    start = perf_counter()
+    result = func(*args)
+    return result, perf_counter() - start
+
+
+def bench_serializer(sizes):
+    """
+    Time the donor serializer against the old iterrows version.
+    """
+    for rows in sizes:
+        opportunities, accounts = synthetic_donors(rows)
+        accounts_dict = accounts.set_index("AccountId")[
+            "Text_For_Donor_Wall__c"
+        ].to_dict()
+        totals = _donor_totals(opportunities)
+
+        old, old_time = _time(_serialize_donors_iterrows, totals, accounts_dict)
+        new, new_time = _time(serialize_donors, totals, accounts_dict)
+        assert old == new
+
+        print(
+            "{:>9,} opportunities {:>9,} totals: "
+            "iterrows {:8.2f}s  vectorized {:6.2f}s  ({:.0f}x)".format(
+                rows, len(totals), old_time, new_time, old_time / new_time
+            )
+        )
+
+
+def bench_compression(sizes):
+    """
+    Compress the donors JSON with every encoding we can publish, at a few
+    levels each, and show the sizes and times. Encodings whose package
+    isn't installed are left out.
+    """
+    for rows in sizes:
+        opportunities, accounts = synthetic_donors(rows)
+        accounts_dict = accounts.set_index("AccountId")[
+            "Text_For_Donor_Wall__c"
+        ].to_dict()
+        donors = serialize_donors(_donor_totals(opportunities), accounts_dict)
+        chunks = [chunk.encode("utf-8") for chunk in json_chunks(donors)]
+        size = sum(len(chunk) for chunk in chunks)
+        print("{:,} opportunities, {:,} bytes of JSON:".format(rows, size))
+
+        for encoding, levels in LEVELS.items():
+            _, start = ENCODINGS[encoding]
+            for level in levels:
+                try:
+                    compress, flush = start(level)
+                except ImportError as e:
+                    print("    {:<5} {}".format(encoding, e))
+                    break
+                began = perf_counter()
+                compressed = sum(len(compress(chunk)) for chunk in chunks)
+                compressed += len(flush())
+                took = perf_counter() - began
+                print(
+                    "    {:<5} level {:>2} {:>12,} bytes ({:5.1%}) in {:6.2f}s".format(
+                        encoding, level, compressed, compressed / size, took
+                    )
+                )
+
+
+def _stages(sponsors, donors, accounts, circle):
+    """
+    The converter stages to measure, in order, as (name, function, make
+    arguments). Arguments are made afresh for every call since some stages
+    change their input.
+    """
+    accounts_dict = accounts.set_index("AccountId")["Text_For_Donor_Wall__c"].to_dict()
+    built = dict()
+
+    def keep(name, func):
+        def stage(*args):
+            built[name] = func(*args)
+            return built[name]
+
+        return stage
+
+    return [
+        (
+            "sponsors:build",
+            keep("sponsors", build_sponsors),
+            lambda: (accounts, sponsors.copy()),
+        ),
+        ("sponsors:json", json.dumps, lambda: (built["sponsors"],)),
+        ("sponsors:compact", compact_sponsors, lambda: (built["sponsors"],)),
+        ("donors:totals", keep("totals", _donor_totals), lambda: (donors.copy(),)),
+        (
+            "donors:serialize",
+            keep("donors", serialize_donors),
+            lambda: (built["totals"], accounts_dict),
+        ),
+        ("donors:json", json.dumps, lambda: (built["donors"],)),
+        ("donors:compact", compact_donors, lambda: (built["donors"],)),
+        ("donors:index", donor_index, lambda: (built["donors"],)),
+        (
+            "circle:map",
+            keep("mapped", _extract_and_map),
+            lambda: (
+                circle,
+                "Text_For_Donor_Wall__c",
+                "Membership_Level_TT__c",
+                "Name",
+            ),
+        ),
+        (
+            "circle:invert",
+            keep("inverted", _invert_and_aggregate),
+            lambda: (built["mapped"],),
+        ),
+        ("circle:sort", keep("sorted", _sort_circle), lambda: (built["inverted"],)),
+        ("circle:strip", _strip_sort_key, lambda: (built["sorted"],)),
+    ]
+
+
+def bench_suite(sizes, seed=0, memory=True, repeat=3):
+    """
+    Time every converter stage at each size, keeping the best of repeat
+    runs, and, unless memory is off,
+    measure its peak memory with tracemalloc in a second run (tracemalloc
+    slows things down, so it's kept out of the timings). Returns the
+    results as a dict that can be saved as JSON.
+    """
+    results = dict()
+    for rows in sizes:
+        data = synthetic_walls(rows, seed)
+        print("{:,} opportunities:".format(rows))
+        results[str(rows)] = stages = dict()
+        for name, func, make_args in _stages(*data):
+            seconds = min(_time(func, *make_args())[1] for _ in range(repeat))
+            stages[name] = {"seconds": seconds}
+            if memory:
+                args = make_args()
+                tracemalloc.start()
+                func(*args)
+                stages[name]["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            print(
+                "    {:<18} {:8.3f}s {:>10}".format(
+                    name,
+                    seconds,
+                    (
+                        "{:,.1f}MB".format(stages[name]["peak_bytes"] / 1024 / 1024)
+                        if memory
+                        else ""
+                    ),
+                )
+            )
+
+    return {
+        "seed": seed,
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "results": results,
+    }
+
+
+def compare(baseline, current, threshold=0.25):
+    """
+    Compare two bench_suite results and return a list of the stages that
+    got more than threshold (a fraction) slower or bigger, ignoring ones
+    below MIN_SECONDS or MIN_PEAK_BYTES in the baseline.
+    """
+    regressions = list()
+    for rows, stages in current["results"].items():
+        for name, measured in stages.items():
+            before = baseline["results"].get(rows, {}).get(name)
+            if before is None:
+                continue
+            for measure, floor in [
+                ("seconds", MIN_SECONDS),
+                ("peak_bytes", MIN_PEAK_BYTES),
+            ]:
+                if measure not in before or measure not in measured:
+                    continue
+                if before[measure] < floor:
+                    continue
+                change = measured[measure] / before[measure] - 1
+                print(
+                    "{:>9} {:<18} {:<10} {:+7.1%}".format(rows, name, measure, change)
+                )
+                if change > threshold:
+                    regressions.append((rows, name, measure, change))
+    return regressions
+
+
+def salesforce_records(rows, seed=0):
+    """
+    Make what FakeSalesforce serves out of synthetic_walls: all of the
+    opportunities, with some that the walls' queries leave out (other
+    stages, Earned Revenue), the accounts, with the circle members'
+    fields, and the business roster.
+    """
+    sponsors, donors, accounts, circle = synthetic_walls(rows, seed)
+    rng = np.random.default_rng(seed + 1)
+    sponsors["Type"] = np.where(
+        rng.random(len(sponsors)) < 0.05, "Earned Revenue", sponsors["Type"]
+    )
+    donors["Type"] = ""
+    donors["Id"] = ["006{:012d}".format(i + len(sponsors)) for i in range(len(donors))]
+    opportunities = pd.concat([sponsors, donors], ignore_index=True)
+    opportunities["StageName"] = rng.choice(STAGES, len(opportunities))
+
+    accounts = accounts.rename(columns={"AccountId": "Id"})
+    accounts["Name"] = accounts["Text_For_Donor_Wall__c"] + " Account"
+    accounts["Membership_Level_TT__c"] = ""
+    accounts["Membership_Status__c"] = ""
+    members = accounts["Text_For_Donor_Wall__c"].isin(
+        [member["Text_For_Donor_Wall__c"] for member in circle]
+    )
+    accounts.loc[members, "Membership_Level_TT__c"] = [
+        member["Membership_Level_TT__c"] for member in circle
+    ]
+    accounts.loc[members, "Membership_Status__c"] = "Current"
+
+    roster = [
+        (name, "http://{}.example.org".format(i), BUSINESS_LEVELS[i % 3])
+        for i, name in enumerate(accounts["Name"][:: max(len(accounts) // 100, 1)])
+    ]
+    return opportunities, accounts, roster
+
+
+def run_end_to_end(salesforce, s3, backend="1.0", cpu_workers=None):
+    """
+    Run walls.py's whole pipeline against a started FakeSalesforce and a
+    FakeS3, the same way its __main__ does, and return the pipeline.
+
+    Everything walls.py shares across a run is set up afresh, and config
+    and the account cache are put back the way they were afterwards. Snapshots and the account cache
+    are left off so every run does the same work.
+    """
+    settings = [
+        (SALESFORCE, "HOST", salesforce.host),
+        (SALESFORCE, "SCHEME", "http"),
+        (BULK, "BACKEND", backend),
+        (CACHE, "SNAPSHOTS", None),
+        (PUBLISH, "VERSIONED", False),
+    ]
+    if cpu_workers is not None:
+        settings.append((PIPELINE, "CPU_WORKERS", cpu_workers))
+    saved = [(config, key, config[key]) for config, key, _ in settings]
+    accounts = walls.accounts
+    try:
+        for config, key, value in settings:
+            config[key] = value
+        walls._connection = None
+        walls._bulk_jobs = None
+        walls._publisher = Publisher(client=s3)
+        walls.accounts = AccountCache(walls.sf_accounts)
+        pipeline = walls.build_pipeline()
+        pipeline.run()
+        walls._publisher.wait()
+        return pipeline
+    finally:
+        for config, key, value in saved:
+            config[key] = value
+        walls._connection = None
+        walls._bulk_jobs = None
+        walls._publisher = None
+        walls.accounts = accounts
+
+
+def bench_end_to_end(
+    sizes, seed=0, backend="1.0", latency=0, page_size=2000, cpu_workers=None
+):
+    """
+    Time the whole of walls.py at each size against a FakeSalesforce,
+    holding back every response by latency seconds, and a FakeS3. Prints
+    each stage and upload as a real run does, then the totals.
+    """
+    for rows in sizes:
+        opportunities, accounts, roster = salesforce_records(rows, seed)
+        s3 = FakeS3()
+        with FakeSalesforce(
+            opportunities, accounts, roster, latency=latency, page_size=page_size
+        ) as salesforce:
+            print("{:,} opportunities:".format(rows))
+            start = perf_counter()
+            pipeline = run_end_to_end(salesforce, s3, backend, cpu_workers)
+            seconds = perf_counter() - start
+        pipeline.report()
+        published = sum(len(obj["Body"]) for obj in s3.objects.values())
+        print(
+            "{:,} opportunities in {:.2f}s ({:,.0f}/s), {} Salesforce requests, "
+            "{} files, {:,} bytes published".format(
+                rows,
+                seconds,
+                rows / seconds,
+                salesforce.requests,
+                len(s3.objects),
+                published,
+            )
+        )
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "benchmark",
+        choices=["serializer", "compression", "suite", "compare", "end-to-end"],
+    )
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000]
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="runs of each stage to take the best of"
+    )
+    parser.add_argument(
+        "--no-memory", action="store_true", help="skip measuring peak memory"
+    )
+    parser.add_argument("--output", help="where suite saves its results")
+    parser.add_argument("--baseline", help="saved suite results to compare to")
+    parser.add_argument("--results", help="saved suite results to check")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.25,
+        help="how much slower or bigger a stage can get, as a fraction",
+    )
+    parser.add_argument(
+        "--backend", choices=["1.0", "2.0"], default="1.0", help="Bulk API to use"
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0,
+        help="seconds the fake Salesforce holds back each response",
+    )
+    parser.add_argument(
+        "--page-size",
+        type=int,
+        default=2000,
+        help="records per page of the fake Salesforce's REST queries",
+    )
+    parser.add_argument(
+        "--cpu-workers", type=int, help="processes for CPU stages (0 runs them inline)"
+    )
+    args = parser.parse_args()
+
+    if args.benchmark == "serializer":
+        bench_serializer(args.sizes)
+    elif args.benchmark == "compression":
+        bench_compression(args.sizes)
+    elif args.benchmark == "suite":
+        results = bench_suite(
+            args.sizes,
+            seed=args.seed,
+            memory=not args.no_memory,
+            repeat=args.repeat,
+        )
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=2)
+    elif args.benchmark == "compare":
+        if not (args.baseline and args.results):
+            parser.error("compare needs --baseline and --results")
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.results) as f:
+            current = json.load(f)
+        regressions = compare(baseline, current, threshold=args.threshold)
+        for rows, name, measure, change in regressions:
+            print(
+                "REGRESSION: {} at {} rows: {} {:+.1%}".format(
+                    name, rows, measure, change
+                )
+            )
+        sys.exit(1 if regressions else 0)
+    elif args.benchmark == "end-to-end":
+        bench_end_to_end(
+            args.sizes,
+            seed=args.seed,
+            backend=args.backend,
+            latency=args.latency,
+            page_size=args.page_size,
+            cpu_workers=args.cpu_workers,
+        )
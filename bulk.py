@@ -0,0 +1,371 @@
+import io
+import re
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from time import sleep
+
+import pandas as pd
+from salesforce_bulk.bulk_states import ABORTED, COMPLETED, FAILED, NOT_PROCESSED
+from salesforce_bulk.salesforce_bulk import BulkBatchFailed
+
+CHUNK_SIZE = 64 * 1024
+
+BULK2_PATH = "/services/data/v52.0/jobs/query"
+
+# How to type the fields we pull out of Salesforce. Anything not listed
+# here is read as text:
+FIELD_DTYPES = {
+    "Id": "object",
+    "AccountId": "object",
+    "RecordTypeId": "object",
+    "Amount": "float64",
+    "CloseDate": "datetime64[ns]",
+}
+
+
+def dtypes_for(query):
+    """
+    Work out the column types for the fields selected by a SOQL query.
+    """
+    select = re.search(r"SELECT\s+(.*?)\s+FROM\s", query, re.IGNORECASE | re.DOTALL)
+    fields = [field.strip() for field in select.group(1).split(",")]
+    return {field: FIELD_DTYPES.get(field, "object") for field in fields}
+
+
+class _ChunkStream(io.RawIOBase):
+    """
+    A read-only file made out of an iterator of byte strings, so pandas can
+    parse a download while it's still coming in.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._buffer:
+            try:
+                self._buffer = next(self._chunks)
+            except StopIteration:
+                return 0
+        size = min(len(buffer), len(self._buffer))
+        buffer[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+
+def read_bulk_csv(stream, dtypes):
+    """
+    Parse one Bulk API CSV result straight into a dataframe.
+
+    Blank text stays as "" (the converters rely on that to spot
+    opportunities without an account); blank numbers and dates become
+    NaN/NaT.
+    """
+    dates = [field for field, dtype in dtypes.items() if dtype == "datetime64[ns]"]
+    others = {field: dtype for field, dtype in dtypes.items() if field not in dates}
+    blanks = {field: [""] for field, dtype in dtypes.items() if dtype != "object"}
+    try:
+        return pd.read_csv(
+            stream,
+            dtype=others,
+            parse_dates=dates,
+            keep_default_na=False,
+            na_values=blanks,
+        )
+    except pd.errors.EmptyDataError:
+        return pd.DataFrame(columns=list(dtypes))
+
+
+def read_bulk_results(bulk, job, batch, dtypes):
+    """
+    Download every result set for a finished query batch and return them
+    as a single dataframe. Each result is parsed as it streams in rather
+    than being collected into rows first.
+    """
+    frames = list()
+    for result in bulk.get_query_batch_result_ids(batch, job_id=job):
+        raw = bulk.get_query_batch_results(batch, result, job_id=job, raw=True)
+        chunks = (
+            chunk.replace(b"\0", b"")
+            for chunk in raw.stream(CHUNK_SIZE, decode_content=True)
+        )
+        stream = io.BufferedReader(_ChunkStream(chunks), CHUNK_SIZE)
+        frames.append(read_bulk_csv(stream, dtypes))
+
+    if not frames:
+        return pd.DataFrame(columns=list(dtypes))
+    return pd.concat(frames, ignore_index=True)
+
+
+class _Job(object):
+    def __init__(self, job, batch, dtypes, chunked=False):
+        self.job = job
+        self.batch = batch
+        self.dtypes = dtypes
+        self.chunked = chunked
+        self.future = Future()
+        # results by batch id, None while a batch is still downloading:
+        self.frames = dict()
+        self.polled_out = False
+        self.lock = threading.Lock()
+
+
+class BulkJobManager(object):
+    """
+    Runs Bulk API query jobs side by side.
+
+    Each job is created, given its query and closed as soon as it's
+    submitted. One poller thread checks on every outstanding batch
+    together: straight away, then at intervals that start at
+    min_interval and grow up to max_interval while nothing is finishing.
+    A batch's results are downloaded the moment it's done.
+
+    Jobs submitted with pk_chunking are split by Salesforce into one batch
+    per chunk of record ids. Each chunk is downloaded on the worker pool
+    as soon as it's done, while the others are still running.
+    """
+
+    def __init__(
+        self,
+        bulk,
+        min_interval=0.5,
+        max_interval=10,
+        backoff=1.5,
+        download_workers=4,
+    ):
+        self.bulk = bulk
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self._downloads = ThreadPoolExecutor(max_workers=download_workers)
+        self._pending = list()
+        self._interval = min_interval
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._poller = None
+
+    def submit(self, object_name, query, include_deleted=False, pk_chunking=None):
+        """
+        Start a query job and return a Future for its results as a
+        dataframe. With include_deleted it runs as queryAll, which also
+        returns deleted records. pk_chunking is the number of records per
+        chunk, if the job should be chunked.
+        """
+        print("Creating {} job...".format(object_name))
+        options = {"contentType": "CSV"}
+        if pk_chunking:
+            options["pk_chunking"] = pk_chunking
+        if include_deleted:
+            job = self.bulk.create_queryall_job(object_name, **options)
+        else:
+            job = self.bulk.create_query_job(object_name, **options)
+        print("Issuing query...")
+        batch = self.bulk.query(job, query)
+        self.bulk.close_job(job)
+
+        pending = _Job(job, batch, dtypes_for(query), chunked=bool(pk_chunking))
+        with self._lock:
+            self._pending.append(pending)
+            self._interval = self.min_interval
+            if self._poller is None:
+                self._poller = threading.Thread(target=self._poll, daemon=True)
+                self._poller.start()
+        self._wakeup.set()
+        return pending.future
+
+    def _poll(self):
+        while True:
+            with self._lock:
+                pending = list(self._pending)
+                if not pending:
+                    self._poller = None
+                    return
+
+            finished = False
+            for job in pending:
+                try:
+                    if job.chunked:
+                        polled_out = self._check_chunks(job)
+                    else:
+                        polled_out = self._check_batch(job)
+                except Exception as e:
+                    finished = True
+                    self._finish(job)
+                    self._fail(job, e)
+                    continue
+                if polled_out:
+                    finished = True
+                    self._finish(job)
+                    with job.lock:
+                        job.polled_out = True
+                        self._complete(job)
+
+            with self._lock:
+                waiting = len(self._pending)
+                if not waiting:
+                    continue
+                # start over from the shortest wait once anything finishes:
+                if finished:
+                    self._interval = self.min_interval
+                interval = self._interval
+                self._interval = min(interval * self.backoff, self.max_interval)
+            print("waiting {:.1f}s for {} queries...".format(interval, waiting))
+            self._wakeup.wait(interval)
+            self._wakeup.clear()
+
+    def _check_batch(self, job):
+        if not self.bulk.is_batch_done(job.batch, job.job):
+            return False
+        self._start_download(job, job.batch)
+        return True
+
+    def _check_chunks(self, job):
+        """
+        Start downloading any chunks that have finished. Returns True once
+        every chunk has finished.
+
+        The batch the query was submitted as never runs itself; it goes to
+        NotProcessed once all of the chunk batches have been created.
+        """
+        running = False
+        for info in self.bulk.get_batch_list(job.job):
+            if info["id"] == job.batch:
+                # it fails outright if Salesforce won't chunk the query:
+                if info["state"] in (ABORTED, FAILED):
+                    raise BulkBatchFailed(
+                        job.job, info["id"], info.get("stateMessage"), info["state"]
+                    )
+                if info["state"] != NOT_PROCESSED:
+                    running = True
+            elif info["state"] in (ABORTED, FAILED, NOT_PROCESSED):
+                raise BulkBatchFailed(
+                    job.job, info["id"], info.get("stateMessage"), info["state"]
+                )
+            elif info["state"] != COMPLETED:
+                running = True
+            elif info["id"] not in job.frames:
+                self._start_download(job, info["id"])
+        return not running
+
+    def _finish(self, job):
+        with self._lock:
+            self._pending.remove(job)
+
+    def _start_download(self, job, batch):
+        with job.lock:
+            job.frames[batch] = None
+        self._downloads.submit(self._download, job, batch)
+
+    def _download(self, job, batch):
+        try:
+            frame = read_bulk_results(self.bulk, job.job, batch, job.dtypes)
+        except Exception as e:
+            self._fail(job, e)
+            return
+        with job.lock:
+            job.frames[batch] = frame
+            self._complete(job)
+
+    def _complete(self, job):
+        # with job.lock held
+        if job.future.done() or not job.polled_out:
+            return
+        frames = list(job.frames.values())
+        if any(frame is None for frame in frames):
+            return
+        if len(frames) == 1:
+            job.future.set_result(frames[0])
+        elif frames:
+            job.future.set_result(pd.concat(frames, ignore_index=True))
+        else:
+            job.future.set_result(pd.DataFrame(columns=list(job.dtypes)))
+
+    def _fail(self, job, error):
+        with job.lock:
+            if not job.future.done():
+                job.future.set_exception(error)
+
+
+class Bulk2JobManager(object):
+    """
+    Runs query jobs through Bulk API 2.0 instead of the older Bulk API
+    that salesforce_bulk speaks. It has the same submit() as
+    BulkJobManager, so either can be used for a run.
+
+    Salesforce chunks 2.0 jobs on its own, so pk_chunking is ignored.
+    Each job is polled with the same growing intervals. Its results are
+    then read a page (page_size records) at a time by following the
+    Sforce-Locator header, and every page is parsed as it streams in,
+    gzipped over the wire.
+    """
+
+    def __init__(
+        self,
+        connection,
+        page_size=100000,
+        min_interval=0.5,
+        max_interval=10,
+        backoff=1.5,
+        workers=4,
+    ):
+        self.connection = connection
+        self.page_size = page_size
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self._jobs = ThreadPoolExecutor(max_workers=workers)
+
+    def submit(self, object_name, query, include_deleted=False, pk_chunking=None):
+        """
+        Start a query job and return a Future for its results as a
+        dataframe. With include_deleted it runs as queryAll, which also
+        returns deleted records.
+        """
+        print("Creating {} job...".format(object_name))
+        r = self.connection.post(
+            BULK2_PATH,
+            json={
+                "operation": "queryAll" if include_deleted else "query",
+                "query": query,
+            },
+        )
+        job = r.json()["id"]
+        return self._jobs.submit(self._run, job, dtypes_for(query))
+
+    def _run(self, job, dtypes):
+        path = "{}/{}".format(BULK2_PATH, job)
+        interval = self.min_interval
+        while True:
+            status = self.connection.get(path).json()
+            if status["state"] == "JobComplete":
+                break
+            if status["state"] in ("Aborted", "Failed"):
+                raise RuntimeError(
+                    "Bulk job {} {}: {}".format(
+                        job, status["state"], status.get("errorMessage")
+                    )
+                )
+            print("waiting {:.1f}s for query to complete...".format(interval))
+            sleep(interval)
+            interval = min(interval * self.backoff, self.max_interval)
+
+        frames = list()
+        params = {"maxRecords": self.page_size}
+        while True:
+            r = self.connection.get(
+                "{}/results".format(path), params=params, stream=True
+            )
+            stream = io.BufferedReader(
+                _ChunkStream(r.iter_content(CHUNK_SIZE)), CHUNK_SIZE
+            )
+            frames.append(read_bulk_csv(stream, dtypes))
+            locator = r.headers.get("Sforce-Locator")
+            if not locator or locator == "null":
+                break
+            params = {"maxRecords": self.page_size, "locator": locator}
+
+        return pd.concat(frames, ignore_index=True)
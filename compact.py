@@ -0,0 +1,116 @@
+from convert import SPONSOR_MONEY_COLUMNS
+
+# A compact form of the sponsor and donor walls, published alongside the
+# original files. Field names and years are listed once up front instead of
+# being repeated in every entry, and sponsors' $0 amounts are left out.
+#
+# The expand_* functions are the reference decoders: given the parsed
+# compact JSON they return exactly what parsing the original file gives.
+FORMAT = "walls-compact-1"
+
+SPONSOR_FIELDS = ("sponsor", "url") + SPONSOR_MONEY_COLUMNS
+
+# what a sponsor's amounts are when they're left out:
+ZERO = "$0"
+
+
+def _year_index(years):
+    return {year: i for i, year in enumerate(years)}
+
+
+def compact_donors(donors):
+    """
+    Turn the list build_donors returns into:
+
+    {"format": FORMAT, "fields": ["name", "donations"],
+     "years": [2009, 2010, "all-time"],
+     "rows": [["Donor A", [0, "$40", 2, "$40"]], ...]}
+
+    where each donor's donations are year index and amount pairs, one
+    after the other.
+    """
+    years = list()
+    for donor in donors:
+        for donation in donor["donations"]:
+            if donation["year"] not in years:
+                years.append(donation["year"])
+    years.sort(key=lambda year: (year == "all-time", str(year)))
+    index = _year_index(years)
+
+    rows = list()
+    for donor in donors:
+        donations = list()
+        for donation in donor["donations"]:
+            donations.extend((index[donation["year"]], donation["amount"]))
+        rows.append([donor["name"], donations])
+    return {
+        "format": FORMAT,
+        "fields": ["name", "donations"],
+        "years": years,
+        "rows": rows,
+    }
+
+
+def expand_donors(compact):
+    """
+    Turn parsed compact donors back into the original list.
+    """
+    years = compact["years"]
+    donors = list()
+    for name, donations in compact["rows"]:
+        donors.append(
+            {
+                "name": name,
+                "donations": [
+                    {"year": years[year], "amount": amount}
+                    for year, amount in zip(donations[::2], donations[1::2])
+                ],
+            }
+        )
+    return donors
+
+
+def compact_sponsors(sponsors):
+    """
+    Turn the dict build_sponsors returns into:
+
+    {"format": FORMAT, "fields": SPONSOR_FIELDS, "zero": "$0",
+     "years": [2009, 2010, "all-time"],
+     "rows": [[0, "Sponsor A", "http://a.org", [2, "$5", 8, "$5"]], ...]}
+
+    where each row is a year index, the sponsor and url, then field
+    index and amount pairs for the amounts that aren't $0.
+    """
+    years = list(sponsors)
+    money = list(enumerate(SPONSOR_FIELDS))[2:]
+    rows = list()
+    for i, year in enumerate(years):
+        for sponsor in sponsors[year]:
+            amounts = list()
+            for field, name in money:
+                if sponsor[name] != ZERO:
+                    amounts.extend((field, sponsor[name]))
+            rows.append([i, sponsor["sponsor"], sponsor["url"], amounts])
+    return {
+        "format": FORMAT,
+        "fields": list(SPONSOR_FIELDS),
+        "zero": ZERO,
+        "years": years,
+        "rows": rows,
+    }
+
+
+def expand_sponsors(compact):
+    """
+    Turn parsed compact sponsors back into the original dict, keyed by
+    year as a string the way JSON keys are.
+    """
+    fields = compact["fields"]
+    sponsors = {str(year): list() for year in compact["years"]}
+    for year, sponsor, url, amounts in compact["rows"]:
+        row = dict.fromkeys(fields, compact["zero"])
+        row.update({fields[0]: sponsor, fields[1]: url})
+        for field, amount in zip(amounts[::2], amounts[1::2]):
+            row[fields[field]] = amount
+        sponsors[str(compact["years"][year])].append(row)
+    return sponsors
@@ -7,11 +7,101 @@ HOURS_TO_EXPIRE = 12
 # where to store the compressed JSON:
 BUCKET = os.getenv("BUCKET", default="membership-test.texastribune.org")
 
+PUBLISH = {
+    # don't upload a file again if what's in the bucket is the same:
+    "SKIP_UNCHANGED": os.getenv("SKIP_UNCHANGED", default="true").lower() == "true",
+    # but do bring its Expires header up to date:
+    "REFRESH_UNCHANGED": os.getenv("REFRESH_UNCHANGED", default="false").lower()
+    == "true",
+    # publish the walls under names that include a hash of their contents,
+    # cacheable for a year, plus a manifest.json of the current names that's
+    # only cacheable for MANIFEST_MAX_AGE seconds:
+    "VERSIONED": os.getenv("PUBLISH_VERSIONED", default="false").lower() == "true",
+    "MANIFEST_MAX_AGE": int(os.getenv("MANIFEST_MAX_AGE", default="60")),
+    # how many uploads to run at once, and the S3 client's connection pool
+    # and attempts per request:
+    "WORKERS": int(os.getenv("PUBLISH_WORKERS", default="4")),
+    "POOL_SIZE": int(os.getenv("S3_POOL_SIZE", default="10")),
+    "MAX_ATTEMPTS": int(os.getenv("S3_MAX_ATTEMPTS", default="5")),
+    # also publish sponsors.compact.json and donors.compact.json (see
+    # compact.py):
+    "COMPACT": os.getenv("PUBLISH_COMPACT", default="false").lower() == "true",
+    # also publish sponsors-index.json and donors-index.json for searching
+    # by name (see search.py):
+    "SEARCH_INDEX": os.getenv("PUBLISH_SEARCH_INDEX", default="false").lower()
+    == "true",
+    # also publish the donors wall split up by initial and by year, under
+    # donors/, with donors/index.json listing the pieces:
+    "SHARD_DONORS": os.getenv("SHARD_DONORS", default="false").lower() == "true",
+    # compressed copies to publish of each file: any of gzip, br (needs the
+    # brotli package) and zstd (needs zstandard), separated by commas:
+    "ENCODINGS": os.getenv("PUBLISH_ENCODINGS", default="gzip").split(","),
+    # and how hard to compress each of them:
+    "LEVELS": {
+        "gzip": int(os.getenv("GZIP_LEVEL", default="9")),
+        "br": int(os.getenv("BROTLI_LEVEL", default="9")),
+        "zstd": int(os.getenv("ZSTD_LEVEL", default="19")),
+    },
+}
+
 SALESFORCE = {
     "USERNAME": os.getenv("SALESFORCE_USERNAME"),
     "PASSWORD": os.getenv("SALESFORCE_PASSWORD"),
     "HOST": os.getenv("SALESFORCE_HOST"),
+    # only changed to talk to a local stand-in (see fakes.py):
+    "SCHEME": os.getenv("SALESFORCE_SCHEME", default="https"),
     "TOKEN": os.getenv("SALESFORCE_TOKEN"),
     "CLIENT_ID": os.getenv("SALESFORCE_CLIENT_ID"),
     "CLIENT_SECRET": os.getenv("SALESFORCE_CLIENT_SECRET"),
+    # log in again after this many seconds, even if the token still works:
+    "SESSION_TIMEOUT": int(os.getenv("SALESFORCE_SESSION_TIMEOUT", default="3600")),
+    # how many HTTP connections to keep open to Salesforce:
+    "POOL_SIZE": int(os.getenv("SALESFORCE_POOL_SIZE", default="10")),
+}
+
+# how many stages of the run can happen at once: IO stages wait on
+# Salesforce and S3, CPU stages transform data in separate processes:
+PIPELINE = {
+    "IO_WORKERS": int(os.getenv("PIPELINE_IO_WORKERS", default="4")),
+    "CPU_WORKERS": int(os.getenv("PIPELINE_CPU_WORKERS", default="2")),
+    # turn each wall into JSON in the worker process, which is much cheaper
+    # to send back than the wall itself but means the whole JSON is held in
+    # memory; by default it's written to S3 a piece at a time instead:
+    "SERIALIZE_IN_WORKERS": os.getenv(
+        "PIPELINE_SERIALIZE_IN_WORKERS", default="false"
+    ).lower()
+    == "true",
+}
+
+# where to keep data between runs; leave unset to fetch everything fresh:
+CACHE = {
+    "ACCOUNTS": os.getenv("ACCOUNTS_CACHE"),
+    "ACCOUNTS_MAX_AGE": float(os.getenv("ACCOUNTS_CACHE_MAX_AGE", default="24")),
+    # SQLite file of opportunity snapshots for incremental extraction:
+    "SNAPSHOTS": os.getenv("SNAPSHOT_DB"),
+    "FULL_REFRESH": os.getenv("FULL_REFRESH", default="false").lower() == "true",
+    # keep totals for years that are over instead of adding them up each run
+    # (needs SNAPSHOT_DB):
+    "FREEZE_YEARS": os.getenv("FREEZE_YEARS", default="false").lower() == "true",
+    # minutes of overlap between one incremental extraction and the next:
+    "OVERLAP": float(os.getenv("SNAPSHOT_OVERLAP", default="5")),
+}
+
+BULK = {
+    # "1.0" for the original Bulk API, "2.0" for Bulk API 2.0:
+    "BACKEND": os.getenv("BULK_BACKEND", default="1.0"),
+    # records per page of Bulk API 2.0 results:
+    "PAGE_SIZE": int(os.getenv("BULK_PAGE_SIZE", default="100000")),
+    # pull sponsor and donor opportunities in one extract and split them up
+    # locally:
+    "COMBINED": os.getenv("BULK_COMBINED", default="false").lower() == "true",
+    # how to avoid pulling every Account: "relationship" pulls the account
+    # fields in with the opportunities, "semijoin" only pulls accounts that
+    # have opportunities on a wall; leave unset to pull them all:
+    "ACCOUNT_PUSHDOWN": os.getenv("BULK_ACCOUNT_PUSHDOWN", default="").lower(),
+    # records per chunk when full Opportunity extracts use PK chunking; 0
+    # turns chunking off:
+    "PK_CHUNK_SIZE": int(os.getenv("BULK_PK_CHUNK_SIZE", default="0")),
+    # how many finished batches to download at once:
+    "DOWNLOAD_WORKERS": int(os.getenv("BULK_DOWNLOAD_WORKERS", default="4")),
 }
@@ -1,6 +1,9 @@
+import hashlib
 import json
+import unicodedata
 from decimal import ROUND_HALF_UP, Decimal
 
+import numpy as np
 import pandas as pd
 
 DIGITAL_PAGES = "01216000001IhIEAA0"
@@ -8,6 +11,17 @@ EVENT_SPONSORSHIPS = "01216000001IhmxAAC"
 BUSINESS_MEMBERSHIP = "01246000000hj93AAA"
 LICENSING = "01216000001IhvaAAC"
 
+# the order these appear in each sponsor on the wall:
+SPONSOR_MONEY_COLUMNS = (
+    "digital_revenue",
+    "digital_in_kind",
+    "events_revenue",
+    "events_in_kind",
+    "business_membership",
+    "licensing",
+    "total",
+)
+
 
 def make_pretty_money(amount):
     """
@@ -19,70 +33,106 @@ def make_pretty_money(amount):
     return amount
 
 
-def licensing(row):
-    """
-    Create licensing column.
+def make_pretty_money_column(amounts, less_than_ten=False):
     """
-    if row["RecordTypeId"] == LICENSING:
-        row["licensing"] = row["Amount"]
-    else:
-        row["licensing"] = 0
-    return row
+    Format a whole column of amounts the way make_pretty_money does
+    (rounding half up to the nearest dollar) and return a list of strings.
 
+    Rounding is done on the exact fractional part of each float so it
+    agrees with Decimal. Formatted strings are memoized by dollar value
+    since the same amounts show up over and over.
 
-def business_membership(row):
+    If less_than_ten is set, amounts that round below $10 become
+    "Less than $10".
     """
-    Create business membership column.
-    """
-    if row["RecordTypeId"] == BUSINESS_MEMBERSHIP:
-        row["business_membership"] = row["Amount"]
-    else:
-        row["business_membership"] = 0
-    return row
+    amounts = np.asarray(amounts, dtype="float64")
+    magnitude = np.abs(amounts)
+    whole = np.floor(magnitude)
+    dollars = whole + (magnitude - whole >= 0.5)
+    negative = np.signbit(amounts)
+    dollars = np.where(negative, -dollars, dollars).astype("int64")
+
+    cache = {}
+    formatted = []
+    for dollar in dollars.tolist():
+        try:
+            pretty = cache[dollar]
+        except KeyError:
+            if less_than_ten and dollar < 10:
+                pretty = "Less than $10"
+            else:
+                pretty = "${:,}".format(dollar)
+            cache[dollar] = pretty
+        formatted.append(pretty)
 
+    # Decimal keeps the sign of a negative amount that rounds to zero:
+    if not less_than_ten:
+        for i in np.flatnonzero(negative & (dollars == 0)):
+            formatted[i] = "$-0"
 
-def digital_revenue(row):
-    """
-    Create digital revenue column.
-    """
-    if row["Type"] != "In-Kind" and row["RecordTypeId"] == DIGITAL_PAGES:
-        row["digital_revenue"] = row["Amount"]
-    else:
-        row["digital_revenue"] = 0
-    return row
+    return formatted
 
 
-def digital_in_kind(row):
-    """
-    Create in kind digital revenue column.
-    """
-    if row["Type"] == "In-Kind" and row["RecordTypeId"] == DIGITAL_PAGES:
-        row["digital_in_kind"] = row["Amount"]
-    else:
-        row["digital_in_kind"] = 0
-    return row
+# Account fields that can be pulled in with the opportunities through the
+# Account relationship, and what they're called on an Account:
+ACCOUNT_FIELDS = {
+    "Account.Text_For_Donor_Wall__c": "Text_For_Donor_Wall__c",
+    "Account.Website": "Website",
+}
 
 
-def events_in_kind(row):
+def split_accounts(opportunities):
     """
-    Create in kind events column.
+    Separate the Account.* fields pulled in with the opportunities into
+    an accounts frame, one row per account, like the one sf_accounts
+    returns. Returns that and the opportunities without those fields.
     """
-    if row["Type"] == "In-Kind" and row["RecordTypeId"] == EVENT_SPONSORSHIPS:
-        row["events_in_kind"] = row["Amount"]
-    else:
-        row["events_in_kind"] = 0
-    return row
+    fields = [field for field in ACCOUNT_FIELDS if field in opportunities]
+    accounts = opportunities[["AccountId"] + fields].drop_duplicates("AccountId")
+    accounts = accounts.rename(columns=ACCOUNT_FIELDS)
+    return accounts, opportunities.drop(columns=fields)
+
+
+# Each revenue column is filled with the opportunity's Amount when its
+# record type matches and the In-Kind test passes (None means either);
+# otherwise it's 0:
+REVENUE_RULES = (
+    ("digital_revenue", DIGITAL_PAGES, False),
+    ("digital_in_kind", DIGITAL_PAGES, True),
+    ("events_revenue", EVENT_SPONSORSHIPS, False),
+    ("events_in_kind", EVENT_SPONSORSHIPS, True),
+    ("business_membership", BUSINESS_MEMBERSHIP, None),
+    ("licensing", LICENSING, None),
+)
 
 
-def events_revenue(row):
+REVENUE_COLUMNS = tuple(column for column, _, _ in REVENUE_RULES)
+
+
+def split_revenue(opportunities, rules=REVENUE_RULES):
     """
-    Create events column.
+    Split the Amount of each opportunity into one column per revenue type.
+
+    This works on whole columns at once: the record type and In-Kind masks
+    are computed a single time and every rule is just a lookup into them.
     """
-    if row["Type"] != "In-Kind" and row["RecordTypeId"] == EVENT_SPONSORSHIPS:
-        row["events_revenue"] = row["Amount"]
-    else:
-        row["events_revenue"] = 0
-    return row
+    amount = opportunities["Amount"].to_numpy()
+    record_type = opportunities["RecordTypeId"].to_numpy()
+    in_kind = (opportunities["Type"] == "In-Kind").to_numpy()
+
+    masks = {}
+    columns = {}
+    for column, record_type_id, is_in_kind in rules:
+        if record_type_id not in masks:
+            masks[record_type_id] = record_type == record_type_id
+        mask = masks[record_type_id]
+        if is_in_kind is True:
+            mask = mask & in_kind
+        elif is_in_kind is False:
+            mask = mask & ~in_kind
+        columns[column] = np.where(mask, amount, 0)
+
+    return opportunities.assign(**columns)
 
 
 def clean_url(string):
@@ -101,14 +151,36 @@ def clean_url(string):
     return "http://" + string
 
 
-def convert_sponsors(accounts, opportunities):
+def convert_sponsors(accounts, opportunities, frozen=None):
     """
     Takes two pandas dataframes: one mapping account IDs to names and URLs
     and another with the opportunities.
 
     It returns a JSON string suitable for use in a web app.
 
+    See build_sponsors for the rest.
     """
+    return json.dumps(build_sponsors(accounts, opportunities, frozen=frozen))
+
+
+def build_sponsors(accounts, opportunities, frozen=None):
+    """
+    Takes two pandas dataframes: one mapping account IDs to names and URLs
+    and another with the opportunities.
+
+    It returns the dict convert_sponsors turns into JSON, with a list of
+    sponsors for each year.
+
+    If accounts is None, the account names and URLs are taken from the
+    Account.* fields of the opportunities instead.
+
+    If frozen (a store.YearlyTotals) is given, totals for closed years are
+    taken from it instead of being added up again.
+
+    """
+
+    if accounts is None:
+        accounts, opportunities = split_accounts(opportunities)
 
     # make a dict mapping Account ID to Sponsor Wall text:
     wall_text_dict = accounts.set_index("AccountId")["Text_For_Donor_Wall__c"].to_dict()
@@ -128,59 +200,80 @@ def convert_sponsors(accounts, opportunities):
     # we only need the year and this will let us pivot by it:
     opportunities["Year"] = [x.year for x in opportunities.CloseDate]
 
-    # these split the different revenue types into different columns
-    # there's probably better/other ways to do this but I don't know
-    # them (yet)
-    opportunities = opportunities.apply(digital_revenue, axis=1)
-    opportunities = opportunities.apply(digital_in_kind, axis=1)
-    opportunities = opportunities.apply(events_revenue, axis=1)
-    opportunities = opportunities.apply(events_in_kind, axis=1)
-    opportunities = opportunities.apply(business_membership, axis=1)
-    opportunities = opportunities.apply(licensing, axis=1)
+    # split the different revenue types into different columns:
+    opportunities = split_revenue(opportunities)
 
     # we no longer need this column now:
     del opportunities["Amount"]
 
-    # calculate all-time numbers and set that as a 'year'
-    all_time = opportunities.pivot_table(index=["AccountId"], aggfunc=sum)
-    all_time.Year = "all-time"
-    all_time = all_time.reset_index()
+    if frozen is None:
+        # calculate all-time numbers and set that as a 'year'
+        all_time = opportunities.pivot_table(index=["AccountId"], aggfunc=sum)
+        all_time.Year = "all-time"
+        all_time = all_time.reset_index()
 
-    both = pd.concat([opportunities, all_time], sort=False)
-    final = both.pivot_table(index=["Year", "AccountId"], aggfunc=sum)
+        both = pd.concat([opportunities, all_time], sort=False)
+        final = both.pivot_table(index=["Year", "AccountId"], aggfunc=sum)
+    else:
+        final = _totals_with_frozen_years(
+            opportunities, REVENUE_COLUMNS, frozen
+        ).swaplevel()
     final["total"] = final.sum(axis=1)
 
+    # format all of the money at once:
+    pretty = pd.DataFrame(
+        {
+            column: make_pretty_money_column(final[column])
+            for column in SPONSOR_MONEY_COLUMNS
+        },
+        index=final.index,
+    )
+
     # convert to a dict that will map to JSON
     final_dict = {}
-    for year, new_df in final.groupby(level=0):
+    for year, new_df in pretty.groupby(level=0):
         year_list = []
-        for row in new_df.iterrows():
-            accountid = row[0][1]
+        accountids = new_df.index.get_level_values(1)
+        for accountid, *amounts in zip(
+            accountids, *[new_df[column] for column in SPONSOR_MONEY_COLUMNS]
+        ):
             account_dict = {
                 "sponsor": wall_text_dict[accountid],
                 "url": clean_url(url_dict[accountid]),
-                "digital_revenue": make_pretty_money(row[1]["digital_revenue"]),
-                "digital_in_kind": make_pretty_money(row[1]["digital_in_kind"]),
-                "events_revenue": make_pretty_money(row[1]["events_revenue"]),
-                "events_in_kind": make_pretty_money(row[1]["events_in_kind"]),
-                "business_membership": make_pretty_money(row[1]["business_membership"]),
-                "licensing": make_pretty_money(row[1]["licensing"]),
-                "total": make_pretty_money(row[1]["total"]),
             }
+            account_dict.update(zip(SPONSOR_MONEY_COLUMNS, amounts))
             year_list.append(account_dict)
         final_dict[year] = sorted(year_list, key=lambda k: k["sponsor"].lower())
 
-    export = json.dumps(final_dict)
-    return export
+    return final_dict
 
 
-def convert_donors(accounts, opportunities):
+def convert_donors(accounts, opportunities, frozen=None):
     """
     Takes two pandas dataframes: one mapping account IDs to names and
     another with the opportunities.
 
     It returns a JSON string suitable for use in a web app.
 
+    See build_donors for the rest.
+    """
+    return json.dumps(build_donors(accounts, opportunities, frozen=frozen))
+
+
+def build_donors(accounts, opportunities, frozen=None):
+    """
+    Takes two pandas dataframes: one mapping account IDs to names and
+    another with the opportunities.
+
+    It returns the list convert_donors turns into JSON, with one entry per
+    donor.
+
+    If accounts is None, the account names are taken from the
+    Account.Text_For_Donor_Wall__c field of the opportunities instead.
+
+    If frozen (a store.YearlyTotals) is given, totals for closed years are
+    taken from it instead of being added up again.
+
     The dataframes should look like this:
 
     opportunities = DataFrame({
@@ -196,9 +289,22 @@ def convert_donors(accounts, opportunities):
 
     """
 
+    if accounts is None:
+        accounts, opportunities = split_accounts(opportunities)
+
     # make a dict mapping Account ID to Donor Wall text:
     accounts_dict = accounts.set_index("AccountId")["Text_For_Donor_Wall__c"].to_dict()
 
+    final = _donor_totals(opportunities, frozen=frozen)
+    return serialize_donors(final, accounts_dict)
+
+
+def _donor_totals(opportunities, frozen=None):
+    """
+    Sum the opportunities by account and year. An "all-time" year is
+    added for each account.
+    """
+
     # make 'Amount' be numeric:
     opportunities["Amount"] = pd.to_numeric(opportunities["Amount"], errors="coerce")
     opportunities = opportunities.dropna()
@@ -211,34 +317,170 @@ def convert_donors(accounts, opportunities):
     # we only need the year and this will let us pivot by it:
     opportunities["Year"] = [x.year for x in opportunities.CloseDate]
 
+    if frozen is not None:
+        return _totals_with_frozen_years(opportunities, ["Amount"], frozen)
+
     all_time = opportunities.pivot_table(index=["AccountId"], aggfunc=sum)
     all_time.Year = "all-time"
     all_time = all_time.reset_index()
     both = pd.concat([opportunities, all_time], sort=False)
     final = both.pivot_table(index=["AccountId", "Year"], aggfunc=sum)
+    return final
+
+
+def _totals_with_frozen_years(opportunities, columns, frozen):
+    """
+    Sum the columns by account and year, reusing frozen totals for closed
+    years and only adding up opportunities in the other years. Newly closed
+    years get frozen.
+
+    The result is indexed by (AccountId, Year) and has an "all-time" year,
+    which is the sum of the years rather than of the opportunities.
+    """
+    saved = frozen.load(columns)
+    saved_years = saved.index.get_level_values("Year").unique()
+
+    fresh = opportunities[~opportunities["Year"].isin(saved_years)]
+    fresh = fresh.groupby(["AccountId", "Year"])[list(columns)].sum()
+    frozen.freeze(fresh)
+
+    yearly = pd.concat([saved, fresh]).sort_index()
+    all_time = yearly.groupby(level="AccountId").sum()
+    all_time["Year"] = "all-time"
+    all_time = all_time.set_index("Year", append=True)
+    return pd.concat([yearly, all_time])
+
+
+def serialize_donors(totals, accounts_dict):
+    """
+    Turn donor totals indexed by (AccountId, Year) into a list like this:
+
+    [{"name": "Donor A", "donations": [{"year": 2009, "amount": "$40"}]}]
+
+    The accounts, years and formatted amounts are pulled out as plain
+    lists once; each donor is then built from a slice of those lists.
+    """
+    accountids, uniques = pd.factorize(totals.index.get_level_values(0), sort=True)
+    order = np.argsort(accountids, kind="stable")
+    bounds = np.concatenate(([0], np.cumsum(np.bincount(accountids)))).tolist()
+
+    years = totals.index.get_level_values(1)[order].tolist()
+    amounts = make_pretty_money_column(
+        totals["Amount"].to_numpy()[order], less_than_ten=True
+    )
 
     final_list = list()
+    for accountid, start, stop in zip(uniques, bounds[:-1], bounds[1:]):
+        donations = [
+            {"year": year, "amount": amount}
+            for year, amount in zip(years[start:stop], amounts[start:stop])
+        ]
+        final_list.append({"name": accounts_dict[accountid], "donations": donations})
+    return final_list
 
-    # convert to a dict that will map to JSON
-    for accountid, new_df in final.groupby(level=0):
-        account_dict = {"name": accounts_dict[accountid]}
-        account_dict["donations"] = list()
-        for row in new_df.iterrows():
-            year = row[0][1]
-            amount = row[1][0]
-            amount = Decimal(amount)
-            amount = amount.quantize(Decimal("1"), rounding=ROUND_HALF_UP)
-            if amount < 10:
-                amount = "Less than $10"
-            else:
-                amount = "${:,.0f}".format(amount)
 
-            donations_dict = {"year": year, "amount": "{0}".format(amount)}
-            account_dict["donations"].append(donations_dict)
-        final_list.append(account_dict)
+def fold(text):
+    """
+    Lowercase text and strip its accents, so "Émile" and "emile" match.
+    """
+    decomposed = unicodedata.normalize("NFKD", text)
+    return "".join(c for c in decomposed if not unicodedata.combining(c)).casefold()
+
+
+def _initial(name):
+    initial = fold(name.strip())[:1]
+    if "a" <= initial <= "z":
+        return initial
+    return "other"
+
 
-    export = json.dumps(final_list)
-    return export
+# how json.dumps writes one of build_donors' entries, given its name and
+# donations already as JSON:
+DONOR_JSON = '{{"name": {}, "donations": [{}]}}'
+
+
+def shard_donors(donors):
+    """
+    Split the list build_donors returns into smaller lists: one per
+    initial letter of the donor's name ("letter-a" ... "letter-z", plus
+    "letter-other"), and one per year ("year-2009" ...) holding just that
+    year's donation for each donor who gave then. Donors stay in the same
+    order as the full list.
+
+    Each shard's entries come back already as JSON. Every name and
+    donation is serialized once, and the entries for all of the shards
+    are put together from those pieces.
+    """
+    shards = dict()
+    for donor in donors:
+        name = json.dumps(donor["name"])
+        donations = [json.dumps(donation) for donation in donor["donations"]]
+        letter = "letter-{}".format(_initial(donor["name"]))
+        shards.setdefault(letter, []).append(
+            DONOR_JSON.format(name, ", ".join(donations))
+        )
+        for donation, serialized in zip(donor["donations"], donations):
+            if donation["year"] == "all-time":
+                continue
+            year = "year-{}".format(donation["year"])
+            shards.setdefault(year, []).append(DONOR_JSON.format(name, serialized))
+    return shards
+
+
+def shard_files(shards, prefix):
+    """
+    Turn the shards shard_donors returns into a dict of file name to JSON,
+    and an index listing each shard's file, size in bytes and sha256:
+
+    {"letter-a": {"file": "donors/letter-a.json", "size": 123,
+                  "sha256": "..."}, ...}
+    """
+    files = dict()
+    index = dict()
+    for name, entries in sorted(shards.items()):
+        filename = "{}/{}.json".format(prefix, name)
+        contents = "[{}]".format(", ".join(entries))
+        encoded = contents.encode("utf-8")
+        files[filename] = contents
+        index[name] = {
+            "file": filename,
+            "size": len(encoded),
+            "sha256": hashlib.sha256(encoded).hexdigest(),
+        }
+    return files, index
+
+
+def json_chunks(data, size=64 * 1024):
+    """
+    Serialize a list or dict a piece at a time, yielding strings of about
+    size characters that add up to exactly what json.dumps(data) returns.
+    Only one item of data is turned into JSON at once.
+
+    Dict keys have to be strings or ints, which is all the walls use.
+    """
+    if isinstance(data, dict):
+        opening, closing = "{", "}"
+        items = (
+            "{}: {}".format(json.dumps(str(key)), json.dumps(value))
+            for key, value in data.items()
+        )
+    else:
+        opening, closing = "[", "]"
+        items = (json.dumps(item) for item in data)
+
+    pending = [opening]
+    pending_size = 1
+    for i, item in enumerate(items):
+        if i:
+            pending.append(", ")
+        pending.append(item)
+        pending_size += len(item)
+        if pending_size >= size:
+            yield "".join(pending)
+            pending = []
+            pending_size = 0
+    pending.append(closing)
+    yield "".join(pending)
 
 
 def _extract_and_map(argument=None, key=None, value=None, sort_key=None):
@@ -0,0 +1,468 @@
+import csv
+import json
+import re
+import threading
+import xml.etree.ElementTree as ET
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from time import sleep, time
+from urllib.parse import parse_qs, urlparse
+
+import pandas as pd
+from botocore.exceptions import ClientError
+
+BULK_NS = "http://www.force.com/2009/06/asyncapi/dataload"
+TOKEN = "fake-access-token"
+
+SELECT = re.compile(
+    r"\s*SELECT\s+(.*?)\s+FROM\s+(\w+)(?:\s+WHERE\s+(.*?))?"
+    r"(?:\s+ORDER\s+BY\s+([\w.]+))?\s*$",
+    re.IGNORECASE | re.DOTALL,
+)
+IN_SELECT = re.compile(r"([\w.]+)\s+IN\s+\(\s*(?=SELECT\b)", re.IGNORECASE)
+IN_LIST = re.compile(r"([\w.]+)\s+IN\s+\(([^()]*)\)", re.IGNORECASE)
+COMPARE = re.compile(r"([\w.]+)\s*(!=|=|LIKE)\s*('[^']*'|-?[\d.]+)", re.IGNORECASE)
+# nothing is ever modified after the data is loaded:
+MODIFIED = re.compile(
+    r"\(?SystemModstamp\s*>\s*[\w:.-]+(?:\s+OR\s+[\w.]+\s*>\s*[\w:.-]+)*\)?"
+)
+AND = re.compile(r"\s*AND\s+", re.IGNORECASE)
+
+
+def _literal(text):
+    if text.startswith("'"):
+        return text[1:-1]
+    return float(text)
+
+
+def _closing_paren(text, start):
+    depth = 0
+    for i in range(start, len(text)):
+        if text[i] == "(":
+            depth += 1
+        elif text[i] == ")":
+            depth -= 1
+            if depth == 0:
+                return i
+    raise ValueError("Unbalanced parentheses in {!r}".format(text))
+
+
+class FakeSalesforce(object):
+    """
+    A stand-in for the parts of Salesforce walls.py talks to, served over
+    HTTP on localhost:
+
+    - the OAuth password login
+    - REST queries, a page (page_size records) at a time
+    - the Analytics report business_roster reads
+    - Bulk API jobs, batches (with PK chunking) and results
+    - Bulk API 2.0 query jobs and their paged results
+
+    Queries run against the opportunities and accounts frames, which
+    should have the fields the queries use (Account's key is Id). Only
+    the SOQL walls.py sends is understood: IN lists and semi-joins, =, !=
+    and LIKE, joined with AND, an ORDER BY and Account.* fields on
+    Opportunity. Nothing counts as modified since the last extraction.
+
+    Every response is held back by latency seconds, and Bulk batches and
+    jobs take batch_seconds to finish.
+    """
+
+    def __init__(
+        self,
+        opportunities,
+        accounts,
+        roster=(),
+        latency=0,
+        page_size=2000,
+        batch_seconds=0,
+    ):
+        self.opportunities = opportunities
+        self.accounts = accounts
+        self.roster = list(roster)
+        self.latency = latency
+        self.page_size = page_size
+        self.batch_seconds = batch_seconds
+        self.requests = 0
+        self._ids = count(1)
+        self._lock = threading.Lock()
+        self._jobs = dict()
+        self._batches = dict()
+        self._cursors = dict()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def host(self):
+        return "127.0.0.1:{}".format(self._server.server_address[1])
+
+    @property
+    def url(self):
+        return "http://{}".format(self.host)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _id(self, prefix):
+        with self._lock:
+            return "{}{:015d}".format(prefix, next(self._ids))
+
+    # Queries
+
+    def run_query(self, query):
+        """
+        Run a SOQL query and return the fields it selects as a dataframe.
+        """
+        match = SELECT.match(query)
+        if match is None:
+            raise ValueError("Can't run query {!r}".format(query))
+        fields, name, where, order_by = match.groups()
+        fields = [field.strip() for field in fields.split(",")]
+
+        if name == "Opportunity":
+            frame = self.opportunities
+            if any(field.startswith("Account.") for field in fields):
+                related = self.accounts.add_prefix("Account.")
+                frame = frame.merge(
+                    related, how="left", left_on="AccountId", right_on="Account.Id"
+                )
+        elif name == "Account":
+            frame = self.accounts
+        else:
+            raise ValueError("No {} records".format(name))
+
+        if where:
+            frame = frame[self._where(frame, where)]
+        if order_by:
+            frame = frame.sort_values(order_by, kind="stable")
+        return frame[fields].reset_index(drop=True)
+
+    def _where(self, frame, where):
+        keep = pd.Series(True, index=frame.index)
+        rest = where.strip()
+        while rest:
+            match = IN_SELECT.match(rest)
+            if match:
+                end = _closing_paren(rest, rest.index("(", match.start()))
+                inner = self.run_query(rest[match.end() : end])
+                keep &= frame[match.group(1)].isin(inner.iloc[:, 0])
+                rest = rest[end + 1 :]
+            else:
+                match = (
+                    IN_LIST.match(rest) or COMPARE.match(rest) or MODIFIED.match(rest)
+                )
+                if match is None:
+                    raise ValueError("Can't handle condition {!r}".format(rest))
+                keep &= self._condition(frame, match)
+                rest = rest[match.end() :]
+            rest = AND.sub("", rest, count=1) if AND.match(rest) else rest.strip()
+        return keep
+
+    def _condition(self, frame, match):
+        if match.re is MODIFIED:
+            return pd.Series(False, index=frame.index)
+        if match.re is IN_LIST:
+            values = re.findall(r"'([^']*)'", match.group(2))
+            return frame[match.group(1)].isin(values)
+        field, operator, value = match.groups()
+        column = frame[field]
+        value = _literal(value)
+        if operator == "=":
+            return column == value
+        if operator == "!=":
+            return column != value
+        pattern = re.escape(value).replace("%", ".*").replace("_", ".")
+        return column.fillna("").str.fullmatch(pattern)
+
+    def _csv(self, frame):
+        return frame.to_csv(
+            index=False, quoting=csv.QUOTE_ALL, date_format="%Y-%m-%d"
+        ).encode("utf-8")
+
+    # Requests
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                self._handle("GET")
+
+            def do_POST(self):
+                self._handle("POST")
+
+            def _handle(self, method):
+                with fake._lock:
+                    fake.requests += 1
+                if fake.latency:
+                    sleep(fake.latency)
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                url = urlparse(self.path)
+                try:
+                    status, headers, content = fake._route(
+                        method, url.path, parse_qs(url.query), self.headers, body
+                    )
+                except Exception as e:
+                    status, headers = 500, {"Content-Type": "text/plain"}
+                    content = str(e).encode("utf-8")
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+        return Handler
+
+    def _route(self, method, path, params, headers, body):
+        if path == "/services/oauth2/token":
+            return self._json({"instance_url": self.url, "access_token": TOKEN})
+
+        authorization = headers.get("Authorization") or ""
+        if TOKEN not in (
+            authorization[len("Bearer ") :],
+            headers.get("X-SFDC-Session"),
+        ):
+            return 401, {"Content-Type": "text/plain"}, b"INVALID_SESSION_ID"
+
+        parts = path.strip("/").split("/")
+        if parts[:2] == ["services", "async"]:
+            return self._bulk(method, parts[3:], headers, body)
+        if parts[:2] == ["services", "data"] and parts[3:5] == ["jobs", "query"]:
+            return self._bulk2(method, parts[5:], params, body)
+        if parts[:2] == ["services", "data"] and parts[3] == "query":
+            return self._rest_query(parts[4:], params)
+        if parts[:2] == ["services", "data"] and parts[3:5] == ["analytics", "reports"]:
+            return self._report()
+        return 404, {"Content-Type": "text/plain"}, b"NOT_FOUND"
+
+    def _json(self, data, status=200, headers=None):
+        headers = dict(headers or {}, **{"Content-Type": "application/json"})
+        return status, headers, json.dumps(data).encode("utf-8")
+
+    def _rest_query(self, cursor, params):
+        if cursor:
+            cursor, start = cursor[0].rsplit("-", 1)
+            with self._lock:
+                records = self._cursors[cursor]
+            start = int(start)
+        else:
+            frame = self.run_query(params["q"][0])
+            records = json.loads(frame.to_json(orient="records"))
+            cursor = self._id("01g")
+            with self._lock:
+                self._cursors[cursor] = records
+            start = 0
+        end = start + self.page_size
+        response = {
+            "totalSize": len(records),
+            "done": end >= len(records),
+            "records": records[start:end],
+        }
+        if response["done"]:
+            # like Salesforce, a query's cursor goes once its last page is read:
+            with self._lock:
+                self._cursors.pop(cursor, None)
+        else:
+            response["nextRecordsUrl"] = "/services/data/v33.0/query/{}-{}".format(
+                cursor, end
+            )
+        return self._json(response)
+
+    def _report(self):
+        rows = [
+            {
+                "dataCells": [
+                    {"label": name, "value": name},
+                    {"label": url, "value": url},
+                    {"label": level, "value": level},
+                ]
+            }
+            for name, url, level in self.roster
+        ]
+        return self._json({"factMap": {"T!T": {"rows": rows}}})
+
+    # Bulk API
+
+    def _xml(self, tag, fields=None, children=()):
+        root = ET.Element(tag, xmlns=BULK_NS)
+        for name, value in (fields or {}).items():
+            ET.SubElement(root, name).text = str(value)
+        for child_tag, child_fields in children:
+            child = ET.SubElement(root, child_tag)
+            for name, value in child_fields.items():
+                ET.SubElement(child, name).text = str(value)
+        return 200, {"Content-Type": "application/xml"}, ET.tostring(root)
+
+    def _batch_info(self, batch):
+        state = batch["state"]
+        if state == "Queued" and time() >= batch["ready_at"]:
+            state = "Completed"
+        return {"id": batch["id"], "jobId": batch["job"], "state": state}
+
+    def _bulk(self, method, parts, headers, body):
+        if parts == ["job"]:
+            doc = ET.fromstring(body)
+            job = {
+                "id": self._id("750"),
+                "operation": doc.findtext("{%s}operation" % BULK_NS),
+                "object": doc.findtext("{%s}object" % BULK_NS),
+                "chunking": headers.get("Sforce-Enable-PKChunking"),
+                "batches": list(),
+            }
+            self._jobs[job["id"]] = job
+            return self._xml("jobInfo", {"id": job["id"], "state": "Open"})
+
+        job = self._jobs[parts[1]]
+        if len(parts) == 2:
+            return self._xml("jobInfo", {"id": job["id"], "state": "Closed"})
+        if len(parts) == 3 and method == "POST":
+            return self._xml("batchInfo", self._batch_info(self._submit(job, body)))
+        if len(parts) == 3:
+            batches = [self._batch_info(self._batches[id]) for id in job["batches"]]
+            return self._xml(
+                "batchInfoList", children=[("batchInfo", info) for info in batches]
+            )
+
+        batch = self._batches[parts[3]]
+        if len(parts) == 4:
+            return self._xml("batchInfo", self._batch_info(batch))
+        if len(parts) == 5:
+            root = ET.Element("result-list", xmlns=BULK_NS)
+            ET.SubElement(root, "result").text = "752" + batch["id"][3:]
+            return 200, {"Content-Type": "application/xml"}, ET.tostring(root)
+        return 200, {"Content-Type": "text/csv"}, self._csv(batch["frame"])
+
+    def _submit(self, job, body):
+        frame = self.run_query(body.decode("utf-8"))
+        ready_at = time() + self.batch_seconds
+        batch = self._add_batch(job, frame, ready_at)
+        match = re.search(r"chunkSize=(\d+)", job["chunking"] or "")
+        if job["chunking"]:
+            size = int(match.group(1)) if match else 100000
+            for start in range(0, max(len(frame), 1), size):
+                self._add_batch(job, frame.iloc[start : start + size], ready_at)
+            batch["state"] = "NotProcessed"
+        return batch
+
+    def _add_batch(self, job, frame, ready_at):
+        batch = {
+            "id": self._id("751"),
+            "job": job["id"],
+            "frame": frame,
+            "state": "Queued",
+            "ready_at": ready_at,
+        }
+        self._batches[batch["id"]] = batch
+        job["batches"].append(batch["id"])
+        return batch
+
+    # Bulk API 2.0
+
+    def _bulk2(self, method, parts, params, body):
+        if not parts:
+            request = json.loads(body)
+            job = {
+                "id": self._id("750"),
+                "frame": self.run_query(request["query"]),
+                "ready_at": time() + self.batch_seconds,
+            }
+            self._jobs[job["id"]] = job
+            return self._json({"id": job["id"], "state": "UploadComplete"})
+
+        job = self._jobs[parts[0]]
+        if len(parts) == 1:
+            done = time() >= job["ready_at"]
+            return self._json({"state": "JobComplete" if done else "InProgress"})
+
+        size = int(params.get("maxRecords", [self.page_size])[0])
+        start = int(params.get("locator", ["0"])[0])
+        end = start + size
+        locator = str(end) if end < len(job["frame"]) else "null"
+        return (
+            200,
+            {"Content-Type": "text/csv", "Sforce-Locator": locator},
+            self._csv(job["frame"].iloc[start:end]),
+        )
+
+
+class FakeS3(object):
+    """
+    An in-process stand-in for the S3 client calls s3.py makes. Objects
+    are kept in a dict, like a bucket.
+    """
+
+    def __init__(self):
+        self.objects = dict()
+        self.multipart = dict()
+        self.uploads = 0
+        self.copies = 0
+        self.parts = 0
+        self.heads = 0
+        self._lock = threading.Lock()
+
+    def head_object(self, Bucket, Key):
+        with self._lock:
+            self.heads += 1
+            if Key not in self.objects:
+                raise ClientError({"Error": {"Code": "404"}}, "HeadObject")
+            return {"Metadata": self.objects[Key]["Metadata"]}
+
+    def upload_fileobj(self, fileobj, bucket, key, ExtraArgs=None):
+        body = fileobj.read()
+        with self._lock:
+            self.uploads += 1
+            self.objects[key] = dict(ExtraArgs, Body=body)
+
+    def copy_object(self, Bucket, Key, CopySource, MetadataDirective, **kwargs):
+        with self._lock:
+            self.copies += 1
+            source = self.objects[CopySource["Key"]]
+            self.objects[Key] = dict(kwargs, Body=source["Body"])
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        with self._lock:
+            self.multipart[Key] = dict(kwargs, Parts=dict())
+        return {"UploadId": Key}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        with self._lock:
+            self.parts += 1
+            self.multipart[UploadId]["Parts"][PartNumber] = Body
+        return {"ETag": "etag{}".format(PartNumber)}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        numbers = [part["PartNumber"] for part in MultipartUpload["Parts"]]
+        with self._lock:
+            self.uploads += 1
+            upload = self.multipart.pop(UploadId)
+            parts = upload.pop("Parts")
+            body = b"".join(parts[number] for number in numbers)
+            self.objects[Key] = dict(upload, Body=body)
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        with self._lock:
+            del self.multipart[UploadId]
+
+    def delete_object(self, Bucket, Key):
+        with self._lock:
+            del self.objects[Key]
@@ -0,0 +1,114 @@
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from time import perf_counter
+
+# Stages that mostly wait on Salesforce or S3 run on threads; stages that
+# crunch data run in separate processes so they don't fight over the GIL:
+IO = "io"
+CPU = "cpu"
+
+
+class Stage(object):
+    """
+    One step in a pipeline. When everything it requires has finished, func
+    is called with their results, in the order they were listed.
+    """
+
+    def __init__(self, name, func, requires=(), kind=IO):
+        self.name = name
+        self.func = func
+        self.requires = tuple(requires)
+        self.kind = kind
+
+
+def _timed(func, *args):
+    start = perf_counter()
+    result = func(*args)
+    return result, perf_counter() - start
+
+
+class Pipeline(object):
+    """
+    Runs stages as soon as the stages they depend on are done.
+
+    Stages have to be added after the stages they require, which keeps
+    cycles out. CPU stages run in a process pool, so their functions and
+    arguments need to be picklable; with cpu_workers=0 they run on the
+    thread pool instead.
+    """
+
+    def __init__(self, io_workers=4, cpu_workers=2):
+        self.io_workers = io_workers
+        self.cpu_workers = cpu_workers
+        self.stages = dict()
+        self.timings = dict()
+        self.elapsed = None
+
+    def add(self, name, func, requires=(), kind=IO):
+        if name in self.stages:
+            raise ValueError("Stage {} was already added".format(name))
+        for requirement in requires:
+            if requirement not in self.stages:
+                raise ValueError(
+                    "Stage {} requires unknown stage {}".format(name, requirement)
+                )
+        if kind not in (IO, CPU):
+            raise ValueError("Unknown kind of stage: {}".format(kind))
+        self.stages[name] = Stage(name, func, requires=requires, kind=kind)
+
+    def run(self):
+        """
+        Run every stage and return a dict of their results by name.
+        """
+        start = perf_counter()
+        results = dict()
+        waiting = dict(self.stages)
+        running = dict()
+
+        io_pool = ThreadPoolExecutor(max_workers=self.io_workers)
+        cpu_pool = io_pool
+        if self.cpu_workers:
+            cpu_pool = ProcessPoolExecutor(max_workers=self.cpu_workers)
+
+        def submit_ready():
+            for name, stage in list(waiting.items()):
+                if all(requirement in results for requirement in stage.requires):
+                    pool = cpu_pool if stage.kind == CPU else io_pool
+                    args = [results[requirement] for requirement in stage.requires]
+                    print("Starting {}...".format(name))
+                    running[pool.submit(_timed, stage.func, *args)] = name
+                    del waiting[name]
+
+        try:
+            submit_ready()
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    results[name], self.timings[name] = future.result()
+                    print("Finished {} in {:.2f}s".format(name, self.timings[name]))
+                submit_ready()
+        finally:
+            for future in running:
+                future.cancel()
+            io_pool.shutdown()
+            cpu_pool.shutdown()
+
+        self.elapsed = perf_counter() - start
+        return results
+
+    def report(self):
+        """
+        Print how long each stage took.
+        """
+        for name, stage in self.stages.items():
+            if name in self.timings:
+                print(
+                    "{:<24} {:<4} {:8.2f}s".format(name, stage.kind, self.timings[name])
+                )
+        if self.elapsed is not None:
+            print("{:<29} {:8.2f}s".format("total (wall clock)", self.elapsed))
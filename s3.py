@@ -1,13 +1,316 @@
-import gzip
+import hashlib
+import json
+import tempfile
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from io import BytesIO
+from time import perf_counter
 
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
 
-from config import BUCKET, HOURS_TO_EXPIRE
+from config import BUCKET, HOURS_TO_EXPIRE, PUBLISH
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
-def push_to_s3(filename=None, contents=None):
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# how much uncompressed text to compress at a time:
+CHUNK_SIZE = 1024 * 1024
+# S3's smallest allowed part, other than the last:
+PART_SIZE = 5 * 1024 * 1024
+
+# how long browsers and CDNs may keep versioned files, which never change:
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+# how many hex digits of the contents' hash go in a versioned file name:
+VERSION_LENGTH = 16
+
+# what push_to_s3 did with a file, from least to most:
+SKIPPED = "skipped"
+REFRESHED = "refreshed"
+WRITTEN = "written"
+STATUSES = (SKIPPED, REFRESHED, WRITTEN)
+
+
+def _gzip(level):
+    # gzip rather than a bare zlib stream:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress, compressor.flush
+
+
+def _brotli(level):
+    if brotli is None:
+        raise ImportError("Publishing with br needs the brotli package")
+    compressor = brotli.Compressor(quality=level)
+    return compressor.process, compressor.finish
+
+
+def _zstd(level):
+    if zstandard is None:
+        raise ImportError("Publishing with zstd needs the zstandard package")
+    compressor = zstandard.ZstdCompressor(level=level).compressobj()
+    return compressor.compress, compressor.flush
+
+
+# For each Content-Encoding we can publish: what's added to the end of the
+# file name and how to start compressing at a given level. gzip keeps the
+# plain name so existing readers carry on working:
+ENCODINGS = {
+    "gzip": ("", _gzip),
+    "br": (".br", _brotli),
+    "zstd": (".zst", _zstd),
+}
+
+
+def _published_hash(s3, filename):
+    """
+    The hash of the uncompressed contents already in the bucket, or None
+    if there's nothing there (or it was uploaded without one).
+    """
+    try:
+        head = s3.head_object(Bucket=BUCKET, Key=filename)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+            return None
+        raise
+    return head.get("Metadata", {}).get("sha256")
+
+
+def versioned_name(filename, sha256):
+    """
+    Put the start of the contents' hash into a file name, before its
+    extension: donors.json becomes donors.0123456789abcdef.json.
+    """
+    base, dot, extension = filename.rpartition(".")
+    version = sha256[:VERSION_LENGTH]
+    if not dot or "/" in extension:
+        return "{}.{}".format(filename, version)
+    return "{}.{}.{}".format(base, version, extension)
+
+
+def _extra_args(sha256, encoding="gzip", max_age=None, immutable=False):
+    """
+    Headers for an upload. By default the file expires HOURS_TO_EXPIRE from
+    now; with max_age it can be cached for that many seconds instead.
+    """
+    extra_args = {
+        "ContentType": "application/json",
+        "ACL": "public-read",
+        "ContentEncoding": encoding,
+        "Metadata": {"sha256": sha256},
+    }
+    if max_age is None:
+        expires = datetime.utcnow() + timedelta(hours=HOURS_TO_EXPIRE)
+        extra_args["CacheControl"] = "public"
+        extra_args["Expires"] = expires.strftime("%a, %d %b %Y %H:%M:%S GMT")
+    else:
+        extra_args["CacheControl"] = "public, max-age={}".format(max_age)
+        if immutable:
+            extra_args["CacheControl"] += ", immutable"
+    return extra_args
+
+
+def _unchanged(s3, filename, extra_args, published):
+    """
+    If the bucket already has these contents (published is the hash it
+    has for them), skip them or refresh their headers and say which;
+    otherwise return None.
+    """
+    if published != extra_args["Metadata"]["sha256"]:
+        return None
+    if not PUBLISH["REFRESH_UNCHANGED"]:
+        return SKIPPED
+    _replace_headers(s3, filename, extra_args)
+    return REFRESHED
+
+
+def _replace_headers(s3, filename, extra_args, source=None):
+    s3.copy_object(
+        Bucket=BUCKET,
+        Key=filename,
+        CopySource={"Bucket": BUCKET, "Key": source or filename},
+        MetadataDirective="REPLACE",
+        **extra_args
+    )
+
+
+class _Variant(object):
+    """
+    One compressed copy of a file on its way to S3. Compressed data is
+    sent off a part (PART_SIZE) at a time in a multipart upload, which is
+    only started once there's more than one part's worth.
+
+    A versioned copy's name depends on the hash of all of the contents, so
+    a multipart upload goes to a .partial name first and is copied over
+    once the name is known.
+
+    If the contents might turn out to be unchanged (with SKIP_UNCHANGED,
+    when the bucket has a hash for the file, or always when versioned),
+    the parts are kept in a temporary file instead, and only uploaded
+    once the hash shows they're needed.
+    """
+
+    def __init__(self, s3, filename, encoding, versioned=False, max_age=None):
+        if encoding not in ENCODINGS:
+            raise ValueError("Unknown encoding: {}".format(encoding))
+        suffix, start = ENCODINGS[encoding]
+        self.s3 = s3
+        self.basename = filename
+        self.suffix = suffix
+        self.filename = filename + suffix
+        self.upload_name = self.filename
+        if versioned:
+            self.upload_name += ".partial"
+            max_age = IMMUTABLE_MAX_AGE
+        self.versioned = versioned
+        self.max_age = max_age
+        self.encoding = encoding
+        self._compress, self._flush = start(PUBLISH["LEVELS"][encoding])
+        self.buffer = bytearray()
+        self.upload = None
+        self.parts = list()
+        self.spool = None
+        self.spooled = list()
+        # a versioned copy's name, and so its hash in the bucket, isn't
+        # known until the end:
+        self.published = None
+        if PUBLISH["SKIP_UNCHANGED"] and not versioned:
+            self.published = _published_hash(s3, self.filename)
+        self.hold = PUBLISH["SKIP_UNCHANGED"] and (
+            versioned or self.published is not None
+        )
+        self.size = 0
+        self.seconds = 0
+
+    def write(self, chunk):
+        start = perf_counter()
+        compressed = self._compress(chunk)
+        self.seconds += perf_counter() - start
+        self._add(compressed)
+        if len(self.buffer) < PART_SIZE:
+            return
+        if self.hold:
+            if self.spool is None:
+                self.spool = tempfile.TemporaryFile()
+            self.spool.write(self.buffer)
+            self.spooled.append(len(self.buffer))
+            self.buffer = bytearray()
+            return
+        if self.upload is None:
+            self._start_upload(
+                _extra_args("", self.encoding, self.max_age, self.versioned)
+            )
+        self._upload_part()
+
+    def _start_upload(self, extra_args):
+        self.upload = self.s3.create_multipart_upload(
+            Bucket=BUCKET, Key=self.upload_name, **extra_args
+        )["UploadId"]
+
+    def _add(self, compressed):
+        self.buffer += compressed
+        self.size += len(compressed)
+
+    def _upload_part(self, body=None):
+        number = len(self.parts) + 1
+        r = self.s3.upload_part(
+            Bucket=BUCKET,
+            Key=self.upload_name,
+            UploadId=self.upload,
+            PartNumber=number,
+            Body=bytes(self.buffer) if body is None else body,
+        )
+        self.parts.append({"ETag": r["ETag"], "PartNumber": number})
+        if body is None:
+            self.buffer = bytearray()
+
+    def finish(self, sha256):
+        """
+        Compress what's left and upload it, unless the bucket already has
+        the same contents. The hash isn't known until the end, so a
+        multipart upload that was already under way gets it afterwards,
+        and an unchanged one is thrown away rather than completed.
+        """
+        start = perf_counter()
+        compressed = self._flush()
+        self.seconds += perf_counter() - start
+        self._add(compressed)
+
+        if self.versioned:
+            self.filename = versioned_name(self.basename, sha256) + self.suffix
+            if PUBLISH["SKIP_UNCHANGED"]:
+                self.published = _published_hash(self.s3, self.filename)
+        extra_args = _extra_args(sha256, self.encoding, self.max_age, self.versioned)
+        status = _unchanged(self.s3, self.filename, extra_args, self.published)
+        if status is not None:
+            self.abort()
+            return status
+
+        if self.spool is not None:
+            self._upload_spool(extra_args)
+            return WRITTEN
+
+        if self.upload is None:
+            self.s3.upload_fileobj(
+                BytesIO(self.buffer), BUCKET, self.filename, ExtraArgs=extra_args
+            )
+            return WRITTEN
+
+        self._upload_part()
+        self.s3.complete_multipart_upload(
+            Bucket=BUCKET,
+            Key=self.upload_name,
+            UploadId=self.upload,
+            MultipartUpload={"Parts": self.parts},
+        )
+        self.upload = None
+        _replace_headers(self.s3, self.filename, extra_args, source=self.upload_name)
+        if self.upload_name != self.filename:
+            self.s3.delete_object(Bucket=BUCKET, Key=self.upload_name)
+        return WRITTEN
+
+    def _upload_spool(self, extra_args):
+        # the final name and headers are known by now, so the parts go
+        # straight there:
+        self.upload_name = self.filename
+        self._start_upload(extra_args)
+        self.spool.seek(0)
+        for size in self.spooled:
+            self._upload_part(self.spool.read(size))
+        self._upload_part()
+        self.s3.complete_multipart_upload(
+            Bucket=BUCKET,
+            Key=self.upload_name,
+            UploadId=self.upload,
+            MultipartUpload={"Parts": self.parts},
+        )
+        self.upload = None
+        self._close_spool()
+
+    def _close_spool(self):
+        if self.spool is not None:
+            self.spool.close()
+            self.spool = None
+
+    def abort(self):
+        self._close_spool()
+        if self.upload is not None:
+            self.s3.abort_multipart_upload(
+                Bucket=BUCKET, Key=self.upload_name, UploadId=self.upload
+            )
+            self.upload = None
+
+
+def push_to_s3(filename=None, contents=None, s3=None, **options):
     """
     Save a file to the the configured bucket with name and contents
     specified in the call.
@@ -17,26 +320,214 @@ def push_to_s3(filename=None, contents=None):
     This sets the contents to be publicly readable, cacheable by
     intermediaries with an expiration date a specified number
     of hours from when this job is run. (See above.)
+
+    A hash of the contents is kept in the object's metadata. If what's
+    already there has the same hash nothing is uploaded; with
+    REFRESH_UNCHANGED=true just its headers are brought up to date.
+    Returns WRITTEN, REFRESHED or SKIPPED.
+
+    Takes the same options as push_stream_to_s3.
     """
-    contents = bytes(contents, "utf-8")
-    out = BytesIO()
-    with gzip.GzipFile(fileobj=out, mode="w") as f:
-        f.write(contents)
-    out.seek(0)
-
-    expires = datetime.utcnow() + timedelta(hours=HOURS_TO_EXPIRE)
-    expires = expires.strftime("%a, %d %b %Y %H:%M:%S GMT")
-
-    s3 = boto3.client("s3")
-    s3.upload_fileobj(
-        out,
-        BUCKET,
-        filename,
-        ExtraArgs={
-            "ContentType": "application/json",
-            "ACL": "public-read",
-            "CacheControl": "public",
-            "Expires": expires,
-            "ContentEncoding": "gzip",
-        },
+    return push_stream_to_s3(filename, _slices(contents), s3=s3, **options)
+
+
+def _slices(contents):
+    return (
+        contents[start : start + CHUNK_SIZE]
+        for start in range(0, len(contents), CHUNK_SIZE)
     )
+
+
+def push_stream_to_s3(
+    filename, chunks, s3=None, encodings=None, versioned=False, max_age=None
+):
+    """
+    Like push_to_s3, but the contents come as an iterator of str or bytes
+    chunks, which are compressed as they arrive, so only about a part's
+    worth of each compressed copy is held in memory however big the file
+    is.
+
+    A copy is published for each of the encodings (PUBLISH_ENCODINGS by
+    default), under the file name plus the encoding's suffix. Their sizes
+    and compression times are printed at the end. Returns the most that
+    happened to any of them.
+
+    With versioned, each copy is named with versioned_name and can be
+    cached for a year, since a different version gets a different name.
+    Otherwise max_age, if given, replaces the Expires header.
+    """
+    return _push_stream(filename, chunks, s3, encodings, versioned, max_age)[0]
+
+
+def _push_stream(
+    filename, chunks, s3=None, encodings=None, versioned=False, max_age=None
+):
+    # push_stream_to_s3, returning the contents' sha256 as well as the
+    # status, so the versioned name is known without hashing them again
+    if s3 is None:
+        s3 = boto3.client("s3")
+    variants = [
+        _Variant(s3, filename, encoding, versioned=versioned, max_age=max_age)
+        for encoding in encodings or PUBLISH["ENCODINGS"]
+    ]
+    sha256 = hashlib.sha256()
+    size = 0
+
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            sha256.update(chunk)
+            size += len(chunk)
+            for variant in variants:
+                variant.write(chunk)
+        statuses = [variant.finish(sha256.hexdigest()) for variant in variants]
+    except BaseException:
+        for variant in variants:
+            variant.abort()
+        raise
+
+    for variant, status in zip(variants, statuses):
+        print(
+            "{:<28} {:>5} {:>12,} bytes ({:5.1%}) in {:.2f}s, {}".format(
+                variant.filename,
+                variant.encoding,
+                variant.size,
+                variant.size / size if size else 1,
+                variant.seconds,
+                status,
+            )
+        )
+    return max(statuses, key=STATUSES.index), sha256.hexdigest()
+
+
+class Publisher(object):
+    """
+    Publishes files to S3 in the background with one shared client, so
+    uploads overlap with whatever the run is still doing.
+
+    publish() and publish_stream() queue an upload and return a Future
+    for its status. wait() blocks until everything queued has finished.
+
+    With versioned, files are published under versioned names, and
+    publish_manifest() writes a manifest of the current names once
+    everything else is up.
+    """
+
+    def __init__(
+        self, workers=4, pool_size=10, max_attempts=5, versioned=False, client=None
+    ):
+        if client is None:
+            client = boto3.client(
+                "s3",
+                config=Config(
+                    max_pool_connections=pool_size,
+                    retries={"max_attempts": max_attempts},
+                ),
+            )
+        self.s3 = client
+        self.versioned = versioned
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._lock = threading.Lock()
+        # (file name, Future) for every upload, in the order they were
+        # queued; a file can be published more than once:
+        self.uploads = list()
+        # how long each upload waited and took, by its Future:
+        self.timings = dict()
+        # the versioned name each file was published under:
+        self.versions = dict()
+
+    def publish(self, filename, contents):
+        """
+        Queue push_to_s3 for a str.
+        """
+        return self.publish_stream(filename, _slices(contents))
+
+    def publish_stream(self, filename, chunks):
+        """
+        Queue push_stream_to_s3 for an iterator of chunks. The iterator is
+        consumed on the publisher's thread.
+        """
+        queued = perf_counter()
+
+        def upload():
+            started = perf_counter()
+            try:
+                status, sha256 = _push_stream(
+                    filename, chunks, s3=self.s3, versioned=self.versioned
+                )
+                if self.versioned:
+                    with self._lock:
+                        self.versions[filename] = versioned_name(filename, sha256)
+                return status
+            finally:
+                finished = perf_counter()
+                with self._lock:
+                    self.timings[future] = (started - queued, finished - started)
+
+        # upload() can't record its timing until future is set:
+        with self._lock:
+            future = self._executor.submit(upload)
+            self.uploads.append((filename, future))
+        return future
+
+    def published_name(self, filename):
+        """
+        The name a finished upload of filename went up under: its versioned
+        name, if the publisher is versioned.
+        """
+        with self._lock:
+            return self.versions.get(filename, filename)
+
+    def publish_manifest(self, filename="manifest.json", max_age=60):
+        """
+        Wait for every upload, then publish a manifest mapping each file's
+        name to its current versioned name. It's only cacheable for
+        max_age seconds, so new versions are picked up soon after. Nothing
+        is written if any upload failed.
+        """
+        self.wait()
+        with self._lock:
+            versions = dict(sorted(self.versions.items()))
+        return push_to_s3(filename, json.dumps(versions), s3=self.s3, max_age=max_age)
+
+    def wait(self):
+        """
+        Wait for every upload queued so far and return their statuses by
+        file name (the last upload's, for a file published more than once).
+        If any failed, the first failure is raised once they've all
+        finished.
+        """
+        with self._lock:
+            uploads = list(self.uploads)
+        statuses = dict()
+        error = None
+        for filename, future in uploads:
+            try:
+                statuses[filename] = future.result()
+            except Exception as e:
+                error = error or e
+        if error is not None:
+            raise error
+        return statuses
+
+    def report(self):
+        """
+        Print how long each upload waited and took.
+        """
+        with self._lock:
+            uploads = list(self.uploads)
+            timings = dict(self.timings)
+        for filename, future in uploads:
+            if future not in timings:
+                continue
+            if future.exception() is None:
+                status = future.result()
+            else:
+                status = "failed"
+            waited, took = timings[future]
+            print(
+                "{:<28} {:<9} queued {:6.2f}s  took {:6.2f}s".format(
+                    filename, status, waited, took
+                )
+            )
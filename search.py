@@ -0,0 +1,67 @@
+import re
+from bisect import bisect_left
+
+from convert import fold
+
+TOKEN = re.compile(r"\w+")
+
+
+def tokens(name):
+    """
+    The searchable words in a name: lowercased, without accents.
+    """
+    return TOKEN.findall(fold(name))
+
+
+def build_index(names):
+    """
+    Index a list of names by their tokens:
+
+    {"tokens": ["acme", "bar", "foo"], "rows": [[0], [1], [0, 1]]}
+
+    tokens is sorted so that every token starting with a prefix can be
+    found with a binary search; rows has the offsets in names of the
+    entries with the token at the same position.
+    """
+    rows = dict()
+    for offset, name in enumerate(names):
+        for token in tokens(name):
+            found = rows.setdefault(token, [])
+            if not found or found[-1] != offset:
+                found.append(offset)
+    ordered = sorted(rows)
+    return {"tokens": ordered, "rows": [rows[token] for token in ordered]}
+
+
+def donor_index(donors):
+    """
+    Index the list build_donors returns; offsets are into that list.
+    """
+    return build_index([donor["name"] for donor in donors])
+
+
+def sponsor_index(sponsors):
+    """
+    Index the dict build_sponsors returns; offsets are into its all-time
+    list, which has every sponsor.
+    """
+    all_time = sponsors.get("all-time", [])
+    return build_index([sponsor["sponsor"] for sponsor in all_time])
+
+
+def search(index, query):
+    """
+    Look a query up in an index the way the front end should: every word
+    of the query has to start some token of the name. Returns the
+    matching offsets in order.
+    """
+    matches = None
+    for word in tokens(query):
+        found = set()
+        start = bisect_left(index["tokens"], word)
+        for token, rows in zip(index["tokens"][start:], index["rows"][start:]):
+            if not token.startswith(word):
+                break
+            found.update(rows)
+        matches = found if matches is None else matches & found
+    return sorted(matches or ())
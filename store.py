@@ -0,0 +1,249 @@
+import os
+import sqlite3
+import threading
+from contextlib import closing
+from datetime import date
+from time import time
+
+import pandas as pd
+
+
+class AccountCache(object):
+    """
+    Holds the Account frame for a run so it's only pulled from Salesforce
+    once, however many walls need it.
+
+    If a path is given the frame is also saved there and reused by later
+    runs until it's older than max_age hours. The saved frame is tied to
+    the text of the query that fetched it; if the query changes it's
+    fetched again.
+    """
+
+    def __init__(self, fetch, path=None, max_age=24, query=None):
+        self.fetch = fetch
+        self.path = path
+        self.max_age = max_age
+        self.query = query
+        self._frame = None
+        self._lock = threading.Lock()
+
+    def _fresh_on_disk(self):
+        if not self.path or not os.path.exists(self.path):
+            return False
+        age = time() - os.path.getmtime(self.path)
+        return age < self.max_age * 60 * 60
+
+    def _load(self):
+        saved = pd.read_pickle(self.path)
+        # caches saved before the query was kept with them are just frames:
+        if isinstance(saved, tuple) and saved[0] == self.query:
+            return saved[1]
+        return None
+
+    def get(self):
+        with self._lock:
+            if self._frame is None:
+                if self._fresh_on_disk():
+                    self._frame = self._load()
+                    if self._frame is not None:
+                        print("Using saved accounts from {}...".format(self.path))
+                if self._frame is None:
+                    self._frame = self.fetch()
+                    if self.path:
+                        self._save()
+            return self._frame
+
+    def _save(self):
+        partial = "{}.partial".format(self.path)
+        pd.to_pickle((self.query, self._frame), partial)
+        os.replace(partial, self.path)
+
+
+class OpportunitySnapshot(object):
+    """
+    A local copy of the opportunities returned by one query, kept in SQLite
+    so later runs only have to ask Salesforce for what's changed since the
+    watermark.
+
+    The snapshot is tied to the text of the query; if the query changes
+    the snapshot is treated as empty.
+    """
+
+    def __init__(self, path, name, query):
+        self.path = path
+        self.name = name
+        self.query = query
+        self.table = "opportunities_{}".format(name)
+        with closing(self._connect()) as db, db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS watermarks "
+                "(name TEXT PRIMARY KEY, query TEXT, watermark TEXT)"
+            )
+
+    def _connect(self):
+        # Writers take the write lock when their transaction starts; a
+        # deferred transaction that reads first can deadlock with another
+        # writer, and SQLite reports that straight away instead of waiting.
+        return sqlite3.connect(self.path, timeout=60, isolation_level="IMMEDIATE")
+
+    def watermark(self):
+        """
+        When the snapshot was last brought up to date, as a SOQL datetime,
+        or None if it has never been filled for this query.
+        """
+        with closing(self._connect()) as db:
+            row = db.execute(
+                "SELECT query, watermark FROM watermarks WHERE name = ?",
+                (self.name,),
+            ).fetchone()
+        if row is None or row[0] != self.query:
+            return None
+        return row[1]
+
+    def load(self, dtypes):
+        """
+        Read the whole snapshot back as a dataframe typed like a fresh
+        extract.
+        """
+        with closing(self._connect()) as db:
+            frame = pd.read_sql("SELECT * FROM {}".format(self.table), db)
+        for field, dtype in dtypes.items():
+            if dtype == "datetime64[ns]":
+                frame[field] = pd.to_datetime(frame[field])
+            else:
+                frame[field] = frame[field].astype(dtype)
+        return frame
+
+    def replace(self, frame, watermark):
+        """
+        Throw away what's stored and keep this frame instead.
+        """
+        with closing(self._connect()) as db, db:
+            frame.to_sql(self.table, db, if_exists="replace", index=False)
+            db.execute(
+                "CREATE INDEX IF NOT EXISTS {0}_id ON {0} (Id)".format(self.table)
+            )
+            self._set_watermark(db, watermark)
+
+    def merge(self, changed_ids, frame, watermark):
+        """
+        Drop every opportunity that changed (or was deleted) since the last
+        watermark, then add back the ones that still match the query.
+
+        Returns the set of close years the change touched, before and
+        after.
+        """
+        with closing(self._connect()) as db, db:
+            db.execute("CREATE TEMP TABLE changed (Id TEXT PRIMARY KEY)")
+            db.executemany(
+                "INSERT OR IGNORE INTO changed VALUES (?)",
+                [(id,) for id in changed_ids],
+            )
+            touched = db.execute(
+                "SELECT DISTINCT substr(CloseDate, 1, 4) FROM {} "
+                "WHERE Id IN (SELECT Id FROM changed)".format(self.table)
+            ).fetchall()
+            db.execute(
+                "DELETE FROM {} WHERE Id IN (SELECT Id FROM changed)".format(self.table)
+            )
+            frame.to_sql(self.table, db, if_exists="append", index=False)
+            self._set_watermark(db, watermark)
+
+        years = {int(year) for year, in touched if year}
+        years.update(pd.to_datetime(frame["CloseDate"]).dt.year.dropna().astype(int))
+        return years
+
+    def _set_watermark(self, db, watermark):
+        db.execute(
+            "INSERT OR REPLACE INTO watermarks VALUES (?, ?, ?)",
+            (self.name, self.query, watermark),
+        )
+
+
+class YearlyTotals(object):
+    """
+    Per account, per year totals for a wall, kept in SQLite so that years
+    that are over don't have to be added up again every run.
+
+    The current and previous years are never frozen. Other years stay
+    frozen until they're invalidated, which happens when an opportunity
+    in them changes.
+    """
+
+    def __init__(self, path, name, current_year=None):
+        self.path = path
+        self.name = name
+        self.table = "totals_{}".format(name)
+        self.current_year = current_year or date.today().year
+
+    def _connect(self):
+        # See OpportunitySnapshot._connect.
+        return sqlite3.connect(self.path, timeout=60, isolation_level="IMMEDIATE")
+
+    def _closed(self, frame):
+        return frame[frame["Year"] < self.current_year - 1]
+
+    def _columns(self, db):
+        """
+        The columns of the saved totals, or None if nothing's saved.
+        """
+        info = db.execute("PRAGMA table_info({})".format(self.table)).fetchall()
+        return [row[1] for row in info] or None
+
+    def load(self, columns):
+        """
+        Return the frozen totals indexed by AccountId and Year. Totals saved
+        with different columns don't count.
+        """
+        columns = ["AccountId", "Year"] + list(columns)
+        with closing(self._connect()) as db:
+            if self._columns(db) == columns:
+                frame = pd.read_sql("SELECT * FROM {}".format(self.table), db)
+            else:
+                frame = pd.DataFrame(columns=columns)
+        frame = self._closed(frame.astype({"Year": "int64"}))
+        return frame.set_index(["AccountId", "Year"])
+
+    def freeze(self, totals):
+        """
+        Save the totals for any closed years in this frame (indexed by
+        AccountId and Year), replacing what was there for those years.
+        """
+        totals = self._closed(totals.reset_index())
+        with closing(self._connect()) as db, db:
+            # Check the saved columns and write under the one lock; to_sql
+            # would commit after creating the table and let another writer
+            # in before the rows are there.
+            db.execute("BEGIN IMMEDIATE")
+            saved = self._columns(db)
+            if saved is not None and saved != list(totals.columns):
+                db.execute("DROP TABLE {}".format(self.table))
+                saved = None
+            if saved is None:
+                db.execute(pd.io.sql.get_schema(totals, self.table))
+            else:
+                self._delete_years(db, totals["Year"].unique().tolist())
+            db.executemany(
+                "INSERT INTO {} VALUES ({})".format(
+                    self.table, ", ".join("?" * len(totals.columns))
+                ),
+                totals.astype(object).itertuples(index=False, name=None),
+            )
+
+    def invalidate(self, years):
+        """
+        Forget the frozen totals for these years.
+        """
+        with closing(self._connect()) as db, db:
+            if self._columns(db) is not None:
+                self._delete_years(db, years)
+
+    def clear(self):
+        with closing(self._connect()) as db, db:
+            db.execute("DROP TABLE IF EXISTS {}".format(self.table))
+
+    def _delete_years(self, db, years):
+        db.executemany(
+            "DELETE FROM {} WHERE Year = ?".format(self.table),
+            [(int(year),) for year in years],
+        )
@@ -1,16 +1,73 @@
+import gzip
+import hashlib
 import json
+import operator
+import re
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
 
+import pytest
 from pandas import DataFrame
+from salesforce_bulk.salesforce_bulk import BulkApiError, BulkBatchFailed
 
+import s3
+import walls
+from bench import bench_suite, compare, run_end_to_end, salesforce_records
+from bulk import (
+    Bulk2JobManager,
+    BulkJobManager,
+    dtypes_for,
+    read_bulk_csv,
+    read_bulk_results,
+)
+from compact import compact_donors, compact_sponsors, expand_donors, expand_sponsors
+from config import PUBLISH
 from convert import (
     _extract_and_map,
     _invert_and_aggregate,
     _sort_circle,
     _strip_sort_key,
+    build_donors,
+    build_sponsors,
     clean_url,
     convert_donors,
     convert_sponsors,
+    fold,
+    json_chunks,
     make_pretty_money,
+    make_pretty_money_column,
+    shard_donors,
+    shard_files,
+    split_accounts,
+    split_revenue,
+)
+from fakes import FakeS3, FakeSalesforce
+from pipeline import CPU, Pipeline
+from s3 import (
+    REFRESHED,
+    SKIPPED,
+    WRITTEN,
+    Publisher,
+    push_stream_to_s3,
+    push_to_s3,
+    versioned_name,
+)
+from search import donor_index, search, sponsor_index
+from store import AccountCache, OpportunitySnapshot, YearlyTotals
+from walls import (
+    SalesforceConnection,
+    accounts_query,
+    accounts_semijoin_query,
+    combined_query,
+    donor_opportunities,
+    donor_shard_files,
+    donors_query,
+    modified_since,
+    publish_shards,
+    sponsor_opportunities,
+    sponsors_query,
+    wall_outputs,
+    with_account_fields,
 )
 
 
@@ -262,6 +319,44 @@ def test_make_pretty_money_round_down():
     assert actual == expected
 
 
+def test_make_pretty_money_column():
+    """
+    Check that formatting a column matches formatting one value at a time,
+    including the half-up rounding edges.
+    """
+
+    amounts = [
+        0,
+        0.49,
+        0.5,
+        4.49,
+        4.5,
+        9.5,
+        10,
+        999.5,
+        1234567.5,
+        0.1 + 0.2,
+        2.675,
+        4.499999999999999,
+        -4.5,
+        -0.4,
+        25.0,
+        25.0,
+    ]
+    expected = [make_pretty_money(amount) for amount in amounts]
+    actual = make_pretty_money_column(amounts)
+    assert actual == expected
+
+
+def test_make_pretty_money_column_less_than_ten():
+    """
+    Check that amounts rounding below $10 are hidden.
+    """
+
+    actual = make_pretty_money_column([9.49, 9.5, 4000], less_than_ten=True)
+    assert actual == ["Less than $10", "$10", "$4,000"]
+
+
 def test_sponsors():
     """
     Do an end-to-end sponsor check.
@@ -469,6 +564,36 @@ def test_sponsors_sort_order():
     assert json.loads(actual) == json.loads(expected)
 
 
+def test_split_revenue():
+    """
+    Check that each opportunity's amount lands in exactly one revenue column.
+    """
+    opportunities = DataFrame(
+        {
+            "Amount": [1.0, 2.0, 3.0, 4.0, 5.0, 6.0],
+            "RecordTypeId": [
+                "01216000001IhIEAA0",
+                "01216000001IhIEAA0",
+                "01216000001IhmxAAC",
+                "01216000001IhmxAAC",
+                "01246000000hj93AAA",
+                "01216000001IhvaAAC",
+            ],
+            "Type": ["Standard", "In-Kind", "", "In-Kind", "In-Kind", ""],
+        }
+    )
+
+    actual = split_revenue(opportunities)
+    assert list(actual["digital_revenue"]) == [1, 0, 0, 0, 0, 0]
+    assert list(actual["digital_in_kind"]) == [0, 2, 0, 0, 0, 0]
+    assert list(actual["events_revenue"]) == [0, 0, 3, 0, 0, 0]
+    assert list(actual["events_in_kind"]) == [0, 0, 0, 4, 0, 0]
+    assert list(actual["business_membership"]) == [0, 0, 0, 0, 5, 0]
+    assert list(actual["licensing"]) == [0, 0, 0, 0, 0, 6]
+    # the input is left alone:
+    assert "licensing" not in opportunities
+
+
 def test__extract_and_map():
     """
     Check that the transform works as expected.
@@ -583,3 +708,1339 @@ def test_clean_url():
     input = "http://"
     actual = clean_url(input)
     assert actual == ""
+
+
+class FakeBulkResult(object):
+    """
+    Stands in for the streamed HTTP response of one Bulk result set.
+    """
+
+    def __init__(self, content):
+        self.content = content
+
+    def stream(self, chunk_size, decode_content=False):
+        # tiny chunks so rows get split across reads:
+        for i in range(0, len(self.content), 7):
+            yield self.content[i : i + 7]
+
+
+class FakeBulk(object):
+    def __init__(self, results):
+        self.results = results
+
+    def get_query_batch_result_ids(self, batch, job_id=None):
+        return list(self.results)
+
+    def get_query_batch_results(self, batch, result, job_id=None, raw=False):
+        return FakeBulkResult(self.results[result])
+
+
+def test_dtypes_for():
+    """
+    Check that column types are picked from the fields in the query.
+    """
+    query = """
+        SELECT Id, AccountId, Amount, CloseDate, Type
+        FROM Opportunity
+    """
+    expected = {
+        "Id": "object",
+        "AccountId": "object",
+        "Amount": "float64",
+        "CloseDate": "datetime64[ns]",
+        "Type": "object",
+    }
+    assert dtypes_for(query) == expected
+
+
+def test_read_bulk_results():
+    """
+    Check that every result set is read, typed and stitched together.
+    """
+    bulk = FakeBulk(
+        {
+            "r1": b'"Id","AccountId","Amount","CloseDate","Type"\n'
+            b'"0061","A01","10.5","2009-01-02","In-Kind"\n'
+            b'"0062","","","2010-03-04",""\n',
+            "r2": b'"Id","AccountId","Amount","CloseDate","Type"\n'
+            b'"0063","B01","4000","2011-05-06","Standard"\n',
+        }
+    )
+    dtypes = dtypes_for(
+        "SELECT Id, AccountId, Amount, CloseDate, Type FROM Opportunity"
+    )
+
+    actual = read_bulk_results(bulk, "job", "batch", dtypes)
+
+    assert list(actual["Id"]) == ["0061", "0062", "0063"]
+    assert list(actual["AccountId"]) == ["A01", "", "B01"]
+    assert list(actual["Type"]) == ["In-Kind", "", "Standard"]
+    assert actual["Amount"].isna().tolist() == [False, True, False]
+    assert actual["Amount"].sum() == 4010.5
+    assert [date.year for date in actual["CloseDate"]] == [2009, 2010, 2011]
+
+
+def test_pipeline():
+    """
+    Check that stages get their requirements' results, in order, and
+    that every stage is timed.
+    """
+    pipeline = Pipeline(io_workers=2, cpu_workers=1)
+    pipeline.add("two", lambda: 2)
+    pipeline.add("ten", lambda: 10)
+    pipeline.add("minus", operator.sub, requires=["ten", "two"], kind=CPU)
+    pipeline.add("double", lambda x: x * 2, requires=["minus"])
+
+    results = pipeline.run()
+
+    assert results == {"two": 2, "ten": 10, "minus": 8, "double": 16}
+    assert set(pipeline.timings) == {"two", "ten", "minus", "double"}
+
+
+def test_pipeline_unknown_requirement():
+    """
+    Stages can only require stages that were added before them.
+    """
+    pipeline = Pipeline()
+    with pytest.raises(ValueError):
+        pipeline.add("publish", print, requires=["transform"])
+
+
+def test_pipeline_failure():
+    """
+    A failing stage stops the run and its error is raised.
+    """
+
+    def fail():
+        raise RuntimeError("Salesforce is down")
+
+    pipeline = Pipeline(cpu_workers=0)
+    pipeline.add("fetch", fail)
+    pipeline.add("publish", print, requires=["fetch"])
+    with pytest.raises(RuntimeError):
+        pipeline.run()
+    assert "publish" not in pipeline.timings
+
+
+def test_account_cache(tmp_path):
+    """
+    Accounts are fetched once per run, and saved ones are reused by the
+    next run while they're fresh.
+    """
+    calls = list()
+
+    def fetch():
+        calls.append(1)
+        return DataFrame({"AccountId": ["A01"], "Website": ["http://A01.com"]})
+
+    path = str(tmp_path / "accounts.pickle")
+
+    cache = AccountCache(fetch, path=path)
+    first = cache.get()
+    assert cache.get() is first
+    assert len(calls) == 1
+
+    next_run = AccountCache(fetch, path=path)
+    assert next_run.get().equals(first)
+    assert len(calls) == 1
+
+    stale = AccountCache(fetch, path=path, max_age=0)
+    stale.get()
+    assert len(calls) == 2
+
+    # accounts fetched with a different query aren't reused:
+    semijoin = AccountCache(fetch, path=path, query=accounts_semijoin_query)
+    semijoin.get()
+    assert len(calls) == 3
+    AccountCache(fetch, path=path, query=accounts_semijoin_query).get()
+    assert len(calls) == 3
+    AccountCache(fetch, path=path, query=accounts_query).get()
+    assert len(calls) == 4
+
+
+def test_opportunity_snapshot(tmp_path):
+    """
+    Check that changed and deleted opportunities are merged into the
+    snapshot.
+    """
+    query = "SELECT Id, AccountId, Amount, CloseDate FROM Opportunity WHERE Amount != 0"
+    dtypes = dtypes_for(query)
+    path = str(tmp_path / "snapshots.db")
+
+    snapshot = OpportunitySnapshot(path, "donors", query)
+    assert snapshot.watermark() is None
+
+    first = read_bulk_csv(
+        BytesIO(
+            b"Id,AccountId,Amount,CloseDate\n"
+            b"0061,A01,10,2009-01-02\n"
+            b"0062,,,2010-01-02\n"
+            b"0063,B01,30,2011-01-02\n"
+        ),
+        dtypes,
+    )
+    snapshot.replace(first, "2020-01-01T00:00:00Z")
+    assert snapshot.watermark() == "2020-01-01T00:00:00Z"
+
+    # 0061 was updated, 0062 was deleted and 0064 is new:
+    updated = read_bulk_csv(
+        BytesIO(
+            b"Id,AccountId,Amount,CloseDate\n0061,A01,15,2009-01-02\n0064,B01,5,2012-01-02\n"
+        ),
+        dtypes,
+    )
+    touched = snapshot.merge(["0061", "0062", "0064"], updated, "2020-01-02T00:00:00Z")
+    assert touched == {2009, 2010, 2012}
+
+    actual = snapshot.load(dtypes).sort_values("Id")
+    assert list(actual["Id"]) == ["0061", "0063", "0064"]
+    assert list(actual["Amount"]) == [15, 30, 5]
+    assert [date.year for date in actual["CloseDate"]] == [2009, 2011, 2012]
+    assert snapshot.watermark() == "2020-01-02T00:00:00Z"
+
+    # a different query can't reuse the snapshot:
+    other = OpportunitySnapshot(path, "donors", query + " AND Amount > 10")
+    assert other.watermark() is None
+
+
+def test_opportunity_snapshot_concurrent_merges(tmp_path):
+    """
+    Two walls merging into the same snapshot file at once take turns
+    instead of deadlocking.
+    """
+    query = "SELECT Id, AccountId, Amount, CloseDate FROM Opportunity"
+    dtypes = dtypes_for(query)
+    path = str(tmp_path / "snapshots.db")
+    frame = read_bulk_csv(
+        BytesIO(b"Id,AccountId,Amount,CloseDate\n0061,A01,10,2009-01-02\n"), dtypes
+    )
+    snapshots = [OpportunitySnapshot(path, name, query) for name in ("a", "b")]
+    for snapshot in snapshots:
+        snapshot.replace(frame, "2020-01-01T00:00:00Z")
+
+    def merge(snapshot):
+        for _ in range(10):
+            snapshot.merge(["0061"], frame, "2020-01-02T00:00:00Z")
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        for future in [executor.submit(merge, snapshot) for snapshot in snapshots]:
+            future.result()
+
+    for snapshot in snapshots:
+        assert list(snapshot.load(dtypes)["Id"]) == ["0061"]
+
+
+def test_modified_since():
+    query = """
+        SELECT Id FROM Opportunity
+        WHERE StageName = 'Pledged'
+    """
+    expected = """
+        SELECT Id FROM Opportunity
+        WHERE StageName = 'Pledged' AND SystemModstamp > 2020-01-01T00:00:00Z"""
+    assert modified_since(query, "2020-01-01T00:00:00Z") == expected
+
+
+def test_modified_since_related():
+    query = "SELECT Id FROM Opportunity WHERE StageName = 'Pledged'"
+    expected = (
+        "SELECT Id FROM Opportunity WHERE StageName = 'Pledged' AND "
+        "(SystemModstamp > 2020-01-01T00:00:00Z "
+        "OR Account.SystemModstamp > 2020-01-01T00:00:00Z)"
+    )
+    assert modified_since(query, "2020-01-01T00:00:00Z", ["Account"]) == expected
+
+
+def _in_list(query, field):
+    values = re.search(r"{} IN \((.*?)\)".format(field), query, re.DOTALL)
+    return set(re.findall(r"'([^']*)'", values.group(1)))
+
+
+def test_combined_query_covers_both_walls():
+    """
+    Check that the combined extract asks for everything the sponsors and
+    donors queries would.
+    """
+    for field in ["RecordTypeId", "StageName"]:
+        assert _in_list(combined_query, field) == _in_list(
+            sponsors_query, field
+        ) | _in_list(donors_query, field)
+    selected = dtypes_for(combined_query)
+    assert set(dtypes_for(sponsors_query)) <= set(selected)
+    assert set(dtypes_for(donors_query)) <= set(selected)
+
+
+def test_split_combined_opportunities():
+    """
+    Check that splitting the combined extract applies the rest of each
+    wall's filter.
+    """
+    opportunities = DataFrame(
+        {
+            "Id": ["1", "2", "3", "4", "5", "6", "7"],
+            "AccountId": ["A01"] * 7,
+            "Amount": [10.0, 0.0, 10.0, float("nan"), 10.0, 10.0, 10.0],
+            "CloseDate": ["2012-01-01"] * 7,
+            "Type": ["", "", "Earned Revenue", "", "", "", ""],
+            "RecordTypeId": [
+                "01216000001IhmxAAC",
+                "01216000001IhmxAAC",
+                "01216000001IhmxAAC",
+                "01216000001IhmxAAC",
+                "01216000001IhHpAAK",
+                "01216000001IhHpAAK",
+                "01216000001IhmxAAC",
+            ],
+            "StageName": [
+                "Closed Won",
+                "Closed Won",
+                "Closed Won",
+                "Invoiced",
+                "Pledged",
+                "Invoiced",
+                "Closed Lost",
+            ],
+        }
+    )
+
+    sponsors = sponsor_opportunities(opportunities)
+    donors = donor_opportunities(opportunities)
+
+    assert list(sponsors["Id"]) == ["1", "4"]
+    assert list(sponsors.columns) == list(dtypes_for(sponsors_query))
+    assert list(donors["Id"]) == ["5"]
+    assert list(donors.columns) == list(dtypes_for(donors_query))
+
+
+def test_with_account_fields():
+    query = with_account_fields(sponsors_query)
+    assert list(dtypes_for(query)) == list(dtypes_for(sponsors_query)) + [
+        "Account.Text_For_Donor_Wall__c",
+        "Account.Website",
+    ]
+    assert query.count("FROM Opportunity") == 1
+
+
+def test_accounts_semijoin_query_covers_both_walls():
+    """
+    Check that the semi-join asks for the accounts of every opportunity
+    either wall could show.
+    """
+    for field in ["RecordTypeId", "StageName"]:
+        assert _in_list(accounts_semijoin_query, field) == _in_list(
+            combined_query, field
+        )
+
+
+def test_convert_with_account_fields():
+    """
+    Check that the converters give the same result when the account fields
+    come with the opportunities instead of in a separate frame.
+    """
+    opportunities = DataFrame(
+        {
+            "AccountId": ["A01", "B01", "A01", ""],
+            "Amount": [10.0, 20.0, 30.0, 50.0],
+            "CloseDate": ["2009-01-02", "2009-01-03", "2010-01-04", "2010-01-02"],
+            "RecordTypeId": ["01216000001IhIEAA0"] * 4,
+            "Type": ["", "In-Kind", "", ""],
+        }
+    )
+    accounts = DataFrame(
+        {
+            "AccountId": ["A01", "B01"],
+            "Text_For_Donor_Wall__c": ["Donor A", "Donor B"],
+            "Website": ["a.org", ""],
+        }
+    )
+    joined = opportunities.assign(
+        **{
+            "Account.Text_For_Donor_Wall__c": ["Donor A", "Donor B", "Donor A", ""],
+            "Account.Website": ["a.org", "", "a.org", ""],
+        }
+    )
+
+    split, rest = split_accounts(joined)
+    assert list(split["AccountId"]) == ["A01", "B01", ""]
+    assert list(split.columns) == ["AccountId", "Text_For_Donor_Wall__c", "Website"]
+    assert list(rest.columns) == list(opportunities.columns)
+
+    assert convert_sponsors(None, joined.copy()) == convert_sponsors(
+        accounts, opportunities.copy()
+    )
+    assert convert_donors(None, joined.copy()) == convert_donors(
+        accounts, opportunities.copy()
+    )
+
+
+def test_convert_donors_frozen_years(tmp_path):
+    """
+    Closed years are added up once and reused until they're invalidated;
+    open years are always added up again.
+    """
+    path = str(tmp_path / "snapshots.db")
+
+    def donors(amounts):
+        opportunities = DataFrame(
+            {
+                "AccountId": ["A01", "A01", "A01"],
+                "Amount": amounts,
+                "CloseDate": ["2009-01-02", "2019-01-03", "2020-01-04"],
+            }
+        )
+        accounts = DataFrame(
+            {"AccountId": ["A01"], "Text_For_Donor_Wall__c": ["Donor A"]}
+        )
+        frozen = YearlyTotals(path, "donors", current_year=2020)
+        actual = convert_donors(
+            opportunities=opportunities, accounts=accounts, frozen=frozen
+        )
+        return {
+            donation["year"]: donation["amount"]
+            for donation in json.loads(actual)[0]["donations"]
+        }
+
+    expected = {2009: "$10", 2019: "$20", 2020: "$30", "all-time": "$60"}
+    assert donors([10.0, 20.0, 30.0]) == expected
+
+    # 2009 is frozen, but 2019 and 2020 are still open:
+    expected = {2009: "$10", 2019: "$25", 2020: "$35", "all-time": "$70"}
+    assert donors([99.0, 25.0, 35.0]) == expected
+
+    YearlyTotals(path, "donors", current_year=2020).invalidate([2009])
+    expected = {2009: "$99", 2019: "$25", 2020: "$35", "all-time": "$159"}
+    assert donors([99.0, 25.0, 35.0]) == expected
+
+
+def test_yearly_totals_concurrent_writers(tmp_path):
+    """
+    Walls freezing and invalidating the same totals at once take turns,
+    so the table is created once and no year is saved twice.
+    """
+    totals = DataFrame(
+        {"AccountId": ["A01", "A01"], "Year": [2009, 2010], "Amount": [10.0, 20.0]}
+    ).set_index(["AccountId", "Year"])
+
+    def write(frozen):
+        frozen.freeze(totals)
+        frozen.invalidate([2009])
+        frozen.freeze(totals)
+
+    for attempt in range(10):
+        path = str(tmp_path / "snapshots{}.db".format(attempt))
+        writers = [YearlyTotals(path, "donors", current_year=2020) for _ in range(2)]
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            list(executor.map(write, writers))
+
+        actual = writers[0].load(["Amount"]).reset_index()
+        assert sorted(actual["Year"]) == [2009, 2010]
+
+
+class FakeResponse(object):
+    def __init__(self, content, status_code=200):
+        self.text = json.dumps(content)
+        self.status_code = status_code
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise RuntimeError(self.status_code)
+
+
+class FakeSession(object):
+    """
+    Hands out a new token for every login and turns down the first token
+    it sees.
+    """
+
+    def __init__(self):
+        self.logins = 0
+        self.gets = list()
+
+    def post(self, url, data=None):
+        self.logins += 1
+        return FakeResponse(
+            {
+                "instance_url": "https://example.my.salesforce.com",
+                "access_token": "token{}".format(self.logins),
+            }
+        )
+
+    def request(self, method, url, headers=None, params=None):
+        self.gets.append((url, headers["Authorization"]))
+        if headers["Authorization"] == "Bearer token1":
+            return FakeResponse([], status_code=401)
+        return FakeResponse({"done": True, "records": [{"Name": "A"}]})
+
+
+def test_salesforce_connection_relogin():
+    """
+    The connection logs in once and only logs in again when its token is
+    turned down.
+    """
+    session = FakeSession()
+    sf = SalesforceConnection(session=session)
+    assert session.logins == 1
+
+    assert sf.query("SELECT Name FROM Account") == [{"Name": "A"}]
+    assert session.logins == 2
+    assert sf.query("SELECT Name FROM Account") == [{"Name": "A"}]
+    assert session.logins == 2
+
+    assert [auth for _, auth in session.gets] == [
+        "Bearer token1",
+        "Bearer token2",
+        "Bearer token2",
+    ]
+    assert session.gets[0][0] == (
+        "https://example.my.salesforce.com/services/data/v33.0/query"
+    )
+
+
+class FakeExpiringBulk(object):
+    """
+    A SalesforceBulk client that turns down the first token the way the
+    Bulk API does.
+    """
+
+    def __init__(self):
+        self.sessionId = None
+        self.calls = list()
+
+    def get_batch_list(self, job):
+        self.calls.append(self.sessionId)
+        if self.sessionId == "token1":
+            raise BulkApiError(
+                "Bulk API HTTP Error result: <exceptionCode>InvalidSessionId",
+                status_code=400,
+            )
+        return [{"id": "batch1", "state": "Completed"}]
+
+
+def test_session_bulk_relogin():
+    """
+    Bulk API calls log in again when the session has expired, like the
+    connection's own requests.
+    """
+    session = FakeSession()
+    sf = SalesforceConnection(session=session)
+    bulk = sf.bulk()
+    bulk.client = FakeExpiringBulk()
+
+    assert bulk.get_batch_list("job1") == [{"id": "batch1", "state": "Completed"}]
+    assert bulk.get_batch_list("job1") == [{"id": "batch1", "state": "Completed"}]
+    assert bulk.client.calls == ["token1", "token2", "token2"]
+    assert session.logins == 2
+
+
+class FakePagingSession(FakeSession):
+    """
+    Returns query results spread over three pages.
+    """
+
+    def request(self, method, url, headers=None, params=None):
+        self.gets.append((url, params))
+        page = int(url.rpartition("-")[2]) if "-" in url else 0
+        content = {
+            "done": page == 2,
+            "records": [{"Id": page * 2}, {"Id": page * 2 + 1}],
+        }
+        if page < 2:
+            content["nextRecordsUrl"] = "/services/data/v33.0/query/01g-{}".format(
+                page + 1
+            )
+        return FakeResponse(content)
+
+
+def test_salesforce_connection_paging():
+    """
+    Check that every page is read, in order, with or without prefetching.
+    """
+    for prefetch in (True, False):
+        session = FakePagingSession()
+        sf = SalesforceConnection(session=session)
+        records = sf.iter_query("SELECT Id FROM Account", prefetch=prefetch)
+        assert [record["Id"] for record in records] == [0, 1, 2, 3, 4, 5]
+        assert [params for _, params in session.gets] == [
+            {"q": "SELECT Id FROM Account"},
+            None,
+            None,
+        ]
+
+    assert len(sf.query("SELECT Id FROM Account")) == 6
+
+
+class FakeBulkJobs(FakeBulk):
+    """
+    A Bulk API client whose batches finish after a set number of polls.
+    """
+
+    def __init__(self, queries):
+        # query -> (polls until done, CSV results); a CSV of None fails
+        self.queries = queries
+        self.events = list()
+        self.polls = dict()
+        self.batches = dict()
+
+    def create_query_job(self, object_name, contentType=None):
+        job = "job{}".format(len(self.batches))
+        self.events.append(("create", job))
+        return job
+
+    def query(self, job, query):
+        batch = "batch-{}".format(job)
+        self.batches[batch] = query
+        self.polls[batch] = 0
+        return batch
+
+    def close_job(self, job):
+        self.events.append(("close", job))
+
+    def is_batch_done(self, batch, job_id=None):
+        self.events.append(("poll", job_id))
+        self.polls[batch] += 1
+        polls, content = self.queries[self.batches[batch]]
+        if content is None:
+            raise RuntimeError("batch failed")
+        return self.polls[batch] >= polls
+
+    def get_query_batch_result_ids(self, batch, job_id=None):
+        return [batch]
+
+    def get_query_batch_results(self, batch, result, job_id=None, raw=False):
+        return FakeBulkResult(self.queries[self.batches[batch]][1])
+
+
+def test_bulk_job_manager():
+    """
+    Jobs are closed straight away, polled together and their results come
+    back as soon as they're done.
+    """
+    quick = "SELECT Id FROM Account"
+    slow = "SELECT Id, Amount FROM Opportunity"
+    broken = "SELECT Id FROM Contact"
+    bulk = FakeBulkJobs(
+        {
+            quick: (1, b"Id\nA01\nB01\n"),
+            slow: (4, b"Id,Amount\n0061,10\n"),
+            broken: (1, None),
+        }
+    )
+    manager = BulkJobManager(bulk, min_interval=0.01, max_interval=0.05)
+
+    slow_result = manager.submit("Opportunity", slow)
+    quick_result = manager.submit("Account", quick)
+    broken_result = manager.submit("Contact", broken)
+
+    assert list(quick_result.result(timeout=5)["Id"]) == ["A01", "B01"]
+    assert list(slow_result.result(timeout=5)["Amount"]) == [10.0]
+    with pytest.raises(RuntimeError):
+        broken_result.result(timeout=5)
+
+    # every job was closed before it was first polled:
+    for job in ("job0", "job1", "job2"):
+        assert bulk.events.index(("close", job)) < bulk.events.index(("poll", job))
+    # and nothing was polled again once it was done:
+    assert bulk.polls == {"batch-job0": 4, "batch-job1": 1, "batch-job2": 1}
+
+
+class FakeWakeup(object):
+    """
+    Stands in for the poller's Event, recording how long it was asked to
+    wait instead of waiting.
+    """
+
+    def __init__(self):
+        self.waits = list()
+
+    def wait(self, interval):
+        self.waits.append(interval)
+
+    def set(self):
+        pass
+
+    def clear(self):
+        pass
+
+
+def test_bulk_job_manager_interval():
+    """
+    The wait between polls grows while nothing finishes and starts over
+    once something does.
+    """
+    quick = "SELECT Id FROM Account"
+    slow = "SELECT Id, Amount FROM Opportunity"
+    bulk = FakeBulkJobs({quick: (2, b"Id\nA01\n"), slow: (5, b"Id,Amount\n0061,10\n")})
+    manager = BulkJobManager(bulk, min_interval=1, max_interval=100, backoff=2)
+    manager._wakeup = FakeWakeup()
+    # keep submit() from starting the poller, so it can be run here:
+    manager._poller = object()
+    quick_result = manager.submit("Account", quick)
+    slow_result = manager.submit("Opportunity", slow)
+    manager._poller = None
+    manager._poll()
+
+    assert list(quick_result.result(timeout=5)["Id"]) == ["A01"]
+    assert list(slow_result.result(timeout=5)["Amount"]) == [10.0]
+    assert manager._wakeup.waits == [1, 1, 2, 4]
+
+
+class FakeChunkedBulk(FakeBulkJobs):
+    """
+    A Bulk API client that splits a PK chunked query into two chunks,
+    which finish one poll apart.
+    """
+
+    def create_query_job(self, object_name, contentType=None, pk_chunking=None):
+        self.pk_chunking = pk_chunking
+        return super().create_query_job(object_name, contentType=contentType)
+
+    def get_batch_list(self, job):
+        self.events.append(("poll", job))
+        polls = self.events.count(("poll", job))
+        states = [
+            ("batch-job0", "Queued"),
+            ("chunk1", "Queued"),
+            ("chunk2", "Queued"),
+        ]
+        if polls >= 2:
+            states = [
+                ("batch-job0", "NotProcessed"),
+                ("chunk1", "Completed"),
+                ("chunk2", "InProgress"),
+            ]
+        if polls >= 3:
+            states[2] = ("chunk2", "Completed")
+        return [{"id": batch, "state": state} for batch, state in states]
+
+    def get_query_batch_results(self, batch, result, job_id=None, raw=False):
+        self.events.append(("download", batch))
+        chunks = {
+            "chunk1": b"Id,Amount\n0061,10\n0062,20\n",
+            "chunk2": b"Id,Amount\n0063,30\n",
+        }
+        return FakeBulkResult(chunks[batch])
+
+
+def test_bulk_job_manager_pk_chunking():
+    """
+    Chunks are downloaded as they finish and put back together.
+    """
+    bulk = FakeChunkedBulk({})
+    manager = BulkJobManager(bulk, min_interval=0.01, max_interval=0.05)
+
+    result = manager.submit(
+        "Opportunity", "SELECT Id, Amount FROM Opportunity", pk_chunking=50000
+    )
+    actual = result.result(timeout=5).sort_values("Id")
+
+    assert bulk.pk_chunking == 50000
+    assert list(actual["Amount"]) == [10.0, 20.0, 30.0]
+    # each chunk was fetched once and polling stopped when both were done:
+    assert bulk.events.count(("download", "chunk1")) == 1
+    assert bulk.events.count(("download", "chunk2")) == 1
+    assert bulk.events.count(("poll", "job0")) == 3
+
+
+class FakeUnchunkableBulk(FakeChunkedBulk):
+    """
+    A Bulk API client where Salesforce turns down PK chunking, so the
+    original batch fails without any chunks being made.
+    """
+
+    def get_batch_list(self, job):
+        self.events.append(("poll", job))
+        return [
+            {
+                "id": "batch-job0",
+                "state": "Failed",
+                "stateMessage": "PK chunking is not supported",
+            }
+        ]
+
+
+def test_bulk_job_manager_pk_chunking_failed():
+    """
+    A query Salesforce won't chunk fails instead of being polled forever.
+    """
+    bulk = FakeUnchunkableBulk({})
+    manager = BulkJobManager(bulk, min_interval=0.01, max_interval=0.05)
+
+    result = manager.submit(
+        "Opportunity", "SELECT Id, Amount FROM Opportunity", pk_chunking=50000
+    )
+    with pytest.raises(BulkBatchFailed):
+        result.result(timeout=5)
+    assert bulk.events.count(("poll", "job0")) == 1
+
+
+class FakeBulk2Response(object):
+    def __init__(self, content=None, body=b"", locator=None):
+        self.content = content
+        self.body = body
+        self.headers = {"Sforce-Locator": locator or "null"}
+
+    def json(self):
+        return self.content
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.body), 5):
+            yield self.body[i : i + 5]
+
+
+class FakeBulk2Connection(object):
+    """
+    A Bulk API 2.0 job that's done on the second poll and has two pages of
+    results.
+    """
+
+    def __init__(self):
+        self.posted = list()
+        self.polls = 0
+        self.pages = list()
+
+    def post(self, path, json=None):
+        self.posted.append((path, json))
+        return FakeBulk2Response({"id": "750x"})
+
+    def get(self, path, params=None, stream=False):
+        if path.endswith("/750x"):
+            self.polls += 1
+            return FakeBulk2Response(
+                {"state": "JobComplete" if self.polls == 2 else "InProgress"}
+            )
+        assert path.endswith("/750x/results")
+        self.pages.append(params)
+        if "locator" not in params:
+            return FakeBulk2Response(
+                body=b'"Id","Amount"\n"0061","10"\n', locator="MjAwMDAw"
+            )
+        return FakeBulk2Response(body=b'"Id","Amount"\n"0062",""\n')
+
+
+def test_bulk2_job_manager():
+    """
+    Check that a Bulk API 2.0 job is polled and every page of its results
+    is read.
+    """
+    connection = FakeBulk2Connection()
+    manager = Bulk2JobManager(connection, page_size=1, min_interval=0.01)
+
+    result = manager.submit(
+        "Opportunity", "SELECT Id, Amount FROM Opportunity", include_deleted=True
+    )
+    actual = result.result(timeout=5)
+
+    assert connection.posted[0][1] == {
+        "operation": "queryAll",
+        "query": "SELECT Id, Amount FROM Opportunity",
+    }
+    assert connection.polls == 2
+    assert connection.pages == [
+        {"maxRecords": 1},
+        {"maxRecords": 1, "locator": "MjAwMDAw"},
+    ]
+    assert list(actual["Id"]) == ["0061", "0062"]
+    assert actual["Amount"].isna().tolist() == [False, True]
+
+
+def test_push_to_s3_skips_unchanged(monkeypatch):
+    """
+    Check that a file is only uploaded again when its contents change, and
+    that unchanged files can have their headers refreshed instead.
+    """
+    monkeypatch.setitem(PUBLISH, "SKIP_UNCHANGED", True)
+    monkeypatch.setitem(PUBLISH, "REFRESH_UNCHANGED", False)
+    fake = FakeS3()
+
+    assert push_to_s3("donors.json", '{"a": 1}', s3=fake) == WRITTEN
+    assert gzip.decompress(fake.objects["donors.json"]["Body"]) == b'{"a": 1}'
+    assert push_to_s3("donors.json", '{"a": 1}', s3=fake) == SKIPPED
+    assert fake.uploads == 1
+    # the bucket's hash is only asked for once per push:
+    assert fake.heads == 2
+
+    monkeypatch.setitem(PUBLISH, "REFRESH_UNCHANGED", True)
+    assert push_to_s3("donors.json", '{"a": 1}', s3=fake) == REFRESHED
+    assert fake.copies == 1
+    assert push_to_s3("donors.json", '{"a": 2}', s3=fake) == WRITTEN
+    assert fake.uploads == 2
+
+    monkeypatch.setitem(PUBLISH, "SKIP_UNCHANGED", False)
+    assert push_to_s3("donors.json", '{"a": 2}', s3=fake) == WRITTEN
+
+
+def test_json_chunks():
+    """
+    Check that the chunks add up to exactly what json.dumps gives.
+    """
+    data = {2009: [{"name": "A", "amount": "$1"}] * 50, "all-time": []}
+    chunks = list(json_chunks(data, size=100))
+    assert len(chunks) > 1
+    assert "".join(chunks) == json.dumps(data)
+    donors = [{"name": "Dönor {}".format(i)} for i in range(20)]
+    assert "".join(json_chunks(donors, size=50)) == json.dumps(donors)
+    assert "".join(json_chunks([])) == "[]"
+
+
+def test_push_stream_to_s3_multipart(monkeypatch):
+    """
+    Check that a stream bigger than a part goes up as a multipart upload
+    that decompresses to the whole thing, with its hash added afterwards.
+    """
+    monkeypatch.setitem(PUBLISH, "SKIP_UNCHANGED", True)
+    monkeypatch.setitem(PUBLISH, "REFRESH_UNCHANGED", False)
+    monkeypatch.setattr(s3, "PART_SIZE", 1024)
+    fake = FakeS3()
+    donors = [{"name": "Donor {}".format(i), "amount": i} for i in range(5000)]
+
+    status = push_stream_to_s3("donors.json", json_chunks(donors, size=1000), s3=fake)
+
+    assert status == WRITTEN
+    assert len(fake.objects["donors.json"]["Body"]) > 1024
+    body = gzip.decompress(fake.objects["donors.json"]["Body"])
+    assert json.loads(body) == donors
+    assert fake.objects["donors.json"]["Metadata"] == {
+        "sha256": hashlib.sha256(body).hexdigest()
+    }
+    assert fake.objects["donors.json"]["ContentEncoding"] == "gzip"
+
+    # an unchanged file isn't sent at all:
+    parts = fake.parts
+    status = push_stream_to_s3("donors.json", json_chunks(donors, size=1000), s3=fake)
+    assert status == SKIPPED
+    assert fake.multipart == {}
+    assert fake.uploads == 1
+    assert fake.parts == parts
+
+    # and a changed one is sent once its hash shows it has to be, with the
+    # hash set up front:
+    donors.append({"name": "Donor 5000", "amount": 5000})
+    copies = fake.copies
+    status = push_stream_to_s3("donors.json", json_chunks(donors, size=1000), s3=fake)
+    assert status == WRITTEN
+    body = gzip.decompress(fake.objects["donors.json"]["Body"])
+    assert json.loads(body) == donors
+    assert fake.objects["donors.json"]["Metadata"] == {
+        "sha256": hashlib.sha256(body).hexdigest()
+    }
+    assert fake.parts > parts
+    assert fake.copies == copies
+
+
+def test_push_stream_to_s3_encodings(monkeypatch):
+    """
+    Check that each encoding gets its own copy under its own name.
+    """
+    brotli = pytest.importorskip("brotli")
+    zstandard = pytest.importorskip("zstandard")
+    monkeypatch.setitem(PUBLISH, "SKIP_UNCHANGED", True)
+    monkeypatch.setattr(s3, "PART_SIZE", 1024)
+    fake = FakeS3()
+    donors = [{"name": "Donor {}".format(i), "amount": i} for i in range(5000)]
+
+    push_stream_to_s3(
+        "donors.json",
+        json_chunks(donors, size=1000),
+        s3=fake,
+        encodings=["gzip", "br", "zstd"],
+    )
+
+    assert sorted(fake.objects) == ["donors.json", "donors.json.br", "donors.json.zst"]
+    assert fake.objects["donors.json.br"]["ContentEncoding"] == "br"
+    assert fake.objects["donors.json.zst"]["ContentEncoding"] == "zstd"
+    expected = json.dumps(donors).encode("utf-8")
+    assert gzip.decompress(fake.objects["donors.json"]["Body"]) == expected
+    assert brotli.decompress(fake.objects["donors.json.br"]["Body"]) == expected
+    decompressor = zstandard.ZstdDecompressor()
+    body = decompressor.decompressobj().decompress(
+        fake.objects["donors.json.zst"]["Body"]
+    )
+    assert body == expected
+
+    with pytest.raises(ValueError):
+        push_stream_to_s3("donors.json", [], s3=fake, encodings=["lzma"])
+
+
+class BrokenS3(FakeS3):
+    def upload_fileobj(self, fileobj, bucket, key, ExtraArgs=None):
+        if key == "broken.json":
+            raise RuntimeError("upload failed")
+        super().upload_fileobj(fileobj, bucket, key, ExtraArgs=ExtraArgs)
+
+
+def test_publisher(monkeypatch):
+    """
+    Check that queued uploads all finish before wait() returns, and that a
+    failed one is raised once the others are done.
+    """
+    monkeypatch.setitem(PUBLISH, "SKIP_UNCHANGED", True)
+    monkeypatch.setitem(PUBLISH, "ENCODINGS", ["gzip"])
+    fake = BrokenS3()
+    publisher = Publisher(workers=2, client=fake)
+
+    publisher.publish("circle-members.json", '{"a": 1}')
+    publisher.publish_stream("donors.json", json_chunks([{"name": "A"}]))
+    assert publisher.wait() == {"circle-members.json": WRITTEN, "donors.json": WRITTEN}
+    assert json.loads(gzip.decompress(fake.objects["donors.json"]["Body"])) == [
+        {"name": "A"}
+    ]
+    assert set(publisher.timings) == {future for _, future in publisher.uploads}
+
+    publisher.publish("broken.json", "{}")
+    publisher.publish("circle-members.json", '{"a": 1}')
+    with pytest.raises(RuntimeError):
+        publisher.wait()
+    filename, future = publisher.uploads[-1]
+    assert filename == "circle-members.json"
+    assert future.result() == SKIPPED
+
+
+class FlakyS3(FakeS3):
+    """
+    Fails the first upload it's asked for.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.failed = False
+
+    def upload_fileobj(self, fileobj, bucket, key, ExtraArgs=None):
+        if not self.failed:
+            self.failed = True
+            raise RuntimeError("upload failed")
+        super().upload_fileobj(fileobj, bucket, key, ExtraArgs=ExtraArgs)
+
+
+def test_publisher_same_file_twice(monkeypatch):
+    """
+    A failed upload is still raised after the same file is published again,
+    and no manifest is written.
+    """
+    monkeypatch.setitem(PUBLISH, "SKIP_UNCHANGED", True)
+    monkeypatch.setitem(PUBLISH, "ENCODINGS", ["gzip"])
+    fake = FlakyS3()
+    publisher = Publisher(workers=1, versioned=True, client=fake)
+
+    publisher.publish("circle-members.json", '{"a": 1}')
+    publisher.publish("circle-members.json", '{"a": 2}')
+    with pytest.raises(RuntimeError):
+        publisher.publish_manifest()
+    assert [filename for filename, _ in publisher.uploads] == [
+        "circle-members.json",
+        "circle-members.json",
+    ]
+    assert "manifest.json" not in fake.objects
+
+
+def test_fold():
+    assert fold("Émile Zoë") == "emile zoe"
+    assert fold("STRASSE") == fold("straße")
+
+
+def test_shard_donors():
+    """
+    Check that donors are split by initial and by year, and that the
+    manifest describes each file.
+    """
+    donors = [
+        {
+            "name": "Ángel",
+            "donations": [
+                {"year": 2009, "amount": "$40"},
+                {"year": "all-time", "amount": "$40"},
+            ],
+        },
+        {
+            "name": "1836 Club",
+            "donations": [
+                {"year": 2009, "amount": "$20"},
+                {"year": 2010, "amount": "$4,000"},
+                {"year": "all-time", "amount": "$4,020"},
+            ],
+        },
+        {
+            "name": "anonymous",
+            "donations": [
+                {"year": 2010, "amount": "Less than $10"},
+                {"year": "all-time", "amount": "Less than $10"},
+            ],
+        },
+    ]
+
+    shards = shard_donors(donors)
+
+    assert sorted(shards) == ["letter-a", "letter-other", "year-2009", "year-2010"]
+    assert shards["letter-a"] == [json.dumps(donors[0]), json.dumps(donors[2])]
+    assert shards["letter-other"] == [json.dumps(donors[1])]
+    assert [json.loads(entry) for entry in shards["year-2010"]] == [
+        {"name": "1836 Club", "donations": [{"year": 2010, "amount": "$4,000"}]},
+        {"name": "anonymous", "donations": [{"year": 2010, "amount": "Less than $10"}]},
+    ]
+
+    files, index = shard_files(shards, "donors")
+    assert files["donors/letter-a.json"] == json.dumps([donors[0], donors[2]])
+    assert sorted(files) == sorted(entry["file"] for entry in index.values())
+    for entry in index.values():
+        contents = files[entry["file"]].encode("utf-8")
+        assert entry["size"] == len(contents)
+        assert entry["sha256"] == hashlib.sha256(contents).hexdigest()
+
+
+def test_publish_shards(monkeypatch):
+    """
+    Check that the shard index only goes up after every shard it lists.
+    """
+    monkeypatch.setitem(PUBLISH, "ENCODINGS", ["gzip"])
+    fake = FakeS3()
+    monkeypatch.setattr("walls._publisher", Publisher(workers=4, client=fake))
+    donors = [
+        {"name": name, "donations": [{"year": 2009 + i % 3, "amount": "$40"}]}
+        for i, name in enumerate(["Ann", "Bea", "Cy", "Di", "Ed", "1836 Club"])
+    ]
+
+    assert publish_shards(donor_shard_files(donors)).result() == WRITTEN
+    assert list(fake.objects)[-1] == "donors/index.json"
+    index = json.loads(gzip.decompress(fake.objects["donors/index.json"]["Body"]))
+    assert sorted(fake.objects) == sorted(
+        [entry["file"] for entry in index.values()] + ["donors/index.json"]
+    )
+
+
+def test_publish_shards_versioned(monkeypatch):
+    """
+    Check that a versioned shard index lists the names the shards were
+    actually published under.
+    """
+    monkeypatch.setitem(PUBLISH, "ENCODINGS", ["gzip"])
+    fake = FakeS3()
+    publisher = Publisher(workers=4, versioned=True, client=fake)
+    monkeypatch.setattr("walls._publisher", publisher)
+    donors = [
+        {"name": name, "donations": [{"year": 2009 + i % 3, "amount": "$40"}]}
+        for i, name in enumerate(["Ann", "Bea", "Cy", "Di", "Ed", "1836 Club"])
+    ]
+
+    publish_shards(donor_shard_files(donors)).result()
+    index_name = publisher.published_name("donors/index.json")
+    index = json.loads(gzip.decompress(fake.objects[index_name]["Body"]))
+    for name, entry in index.items():
+        assert entry["file"] in fake.objects
+        assert entry["file"] != "donors/{}.json".format(name)
+
+
+def test_wall_outputs():
+    """
+    Check that a wall and its outputs come back as JSON for the process
+    pool, except for ones that are already JSON, and as they are
+    otherwise.
+    """
+    donors = [{"name": "Ann", "donations": [{"year": 2009, "amount": "$40"}]}]
+    derived = [("index", donor_index, True), ("shards", donor_shard_files, False)]
+
+    outputs = wall_outputs(lambda: donors, derived, True)
+    assert outputs["wall"] == json.dumps(donors)
+    assert outputs["index"] == json.dumps(donor_index(donors))
+    assert outputs["shards"] == donor_shard_files(donors)
+
+    outputs = wall_outputs(lambda: donors, derived, False)
+    assert outputs["wall"] is donors
+    assert outputs["index"] == donor_index(donors)
+
+
+def _wall_frames(count):
+    """
+    A few years of opportunities for count accounts, spread over every
+    sponsor record type.
+    """
+    record_types = [
+        "01216000001IhIEAA0",
+        "01216000001IhmxAAC",
+        "01246000000hj93AAA",
+        "01216000001IhvaAAC",
+    ]
+    rows = [
+        (
+            "A{:04d}".format(i),
+            float(i % 7 * 25 + 5),
+            "{}-06-01".format(2009 + (i + j) % 8),
+            record_types[(i + j) % 4],
+            "In-Kind" if (i + j) % 5 == 0 else "",
+        )
+        for i in range(count)
+        for j in range(3)
+    ]
+    opportunities = DataFrame(
+        rows, columns=["AccountId", "Amount", "CloseDate", "RecordTypeId", "Type"]
+    )
+    accounts = DataFrame(
+        {
+            "AccountId": ["A{:04d}".format(i) for i in range(count)],
+            "Text_For_Donor_Wall__c": ["Friend {}".format(i) for i in range(count)],
+            "Website": ["friend{}.org".format(i) for i in range(count)],
+        }
+    )
+    return opportunities, accounts
+
+
+def test_compact_donors():
+    """
+    Check that compact donors decode back to the original and are much
+    smaller.
+    """
+    opportunities, accounts = _wall_frames(200)
+    legacy = json.dumps(build_donors(accounts, opportunities.copy()))
+    donors = build_donors(accounts, opportunities.copy())
+
+    compact = json.dumps(compact_donors(donors))
+
+    assert expand_donors(json.loads(compact)) == json.loads(legacy)
+    assert len(compact) < len(legacy) * 0.5
+
+
+def test_compact_sponsors():
+    """
+    Check that compact sponsors decode back to the original and are much
+    smaller.
+    """
+    opportunities, accounts = _wall_frames(200)
+    legacy = json.dumps(build_sponsors(accounts, opportunities.copy()))
+    sponsors = build_sponsors(accounts, opportunities.copy())
+
+    compact = json.dumps(compact_sponsors(sponsors))
+
+    expanded = expand_sponsors(json.loads(compact))
+    assert expanded == json.loads(legacy)
+    assert list(expanded) == list(json.loads(legacy))
+    assert len(compact) < len(legacy) * 0.5
+
+
+def test_search_index():
+    """
+    Check that names are found by accent-folded word prefixes.
+    """
+    donors = [
+        {"name": "José Martínez", "donations": []},
+        {"name": "Jane & Joe Smith", "donations": []},
+        {"name": "Smithson Foundation", "donations": []},
+    ]
+    index = donor_index(donors)
+
+    assert index["tokens"] == sorted(index["tokens"])
+    assert search(index, "jose") == [0]
+    assert search(index, "MART") == [0]
+    assert search(index, "smith") == [1, 2]
+    assert search(index, "jo smi") == [1]
+    assert search(index, "zzz") == []
+    assert json.loads(json.dumps(index)) == index
+
+    sponsors = {
+        2009: [{"sponsor": "Émile's Café"}],
+        "all-time": [{"sponsor": "Acme"}, {"sponsor": "Émile's Café"}],
+    }
+    assert search(sponsor_index(sponsors), "cafe") == [1]
+
+
+def test_versioned_name():
+    sha256 = hashlib.sha256(b"{}").hexdigest()
+    assert versioned_name("donors.json", sha256) == "donors.44136fa355b3678a.json"
+    assert versioned_name("donors/index.json", sha256).startswith("donors/index.4")
+    assert versioned_name("walls.d/README", sha256) == "walls.d/README.44136fa355b3678a"
+
+
+def test_publisher_versioned(monkeypatch):
+    """
+    Check that versioned files go up under their hashed names with a long
+    cache lifetime, and that the manifest points at them.
+    """
+    monkeypatch.setitem(PUBLISH, "SKIP_UNCHANGED", True)
+    monkeypatch.setitem(PUBLISH, "REFRESH_UNCHANGED", False)
+    monkeypatch.setitem(PUBLISH, "ENCODINGS", ["gzip"])
+    monkeypatch.setattr(s3, "PART_SIZE", 1024)
+    fake = FakeS3()
+    publisher = Publisher(versioned=True, client=fake)
+    donors = [{"name": "Donor {}".format(i), "amount": i} for i in range(5000)]
+
+    publisher.publish("circle-members.json", '{"a": 1}')
+    publisher.publish_stream("donors.json", json_chunks(donors, size=1000))
+    assert publisher.publish_manifest(max_age=60) == WRITTEN
+
+    manifest = json.loads(gzip.decompress(fake.objects["manifest.json"]["Body"]))
+    assert sorted(manifest) == ["circle-members.json", "donors.json"]
+    assert sorted(fake.objects) == sorted(list(manifest.values()) + ["manifest.json"])
+    assert fake.objects["manifest.json"]["CacheControl"] == "public, max-age=60"
+    assert "Expires" not in fake.objects["manifest.json"]
+
+    donors_file = fake.objects[manifest["donors.json"]]
+    body = gzip.decompress(donors_file["Body"])
+    assert json.loads(body) == donors
+    assert manifest["donors.json"] == versioned_name(
+        "donors.json", hashlib.sha256(body).hexdigest()
+    )
+    assert donors_file["CacheControl"] == "public, max-age=31536000, immutable"
+    assert "Expires" not in donors_file
+
+    publisher.publish_stream("donors.json", json_chunks(donors, size=1000))
+    assert publisher.wait()["donors.json"] == SKIPPED
+    assert fake.multipart == {}
+
+
+def test_bench_suite(capsys):
+    """
+    Check that the synthetic data makes it through every converter stage,
+    and that a stage getting much slower counts as a regression.
+    """
+    results = bench_suite([1000], repeat=1)
+    stages = results["results"]["1000"]
+    assert "donors:serialize" in stages
+    assert all(stage["peak_bytes"] > 0 for stage in stages.values())
+
+    baseline = {"results": {"1000": {"donors:totals": {"seconds": 1.0}}}}
+    current = {"results": {"1000": {"donors:totals": {"seconds": 1.2}}}}
+    assert compare(baseline, current, threshold=0.25) == []
+    current["results"]["1000"]["donors:totals"]["seconds"] = 2.0
+    assert compare(baseline, current, threshold=0.25) == [
+        ("1000", "donors:totals", "seconds", 1.0)
+    ]
+    baseline["results"]["1000"]["donors:totals"]["seconds"] = 0.001
+    assert compare(baseline, current) == []
+
+
+@pytest.mark.parametrize("backend", ["1.0", "2.0"])
+def test_end_to_end(backend):
+    """
+    Check that the whole pipeline runs against the fake Salesforce and S3,
+    through either Bulk API and with REST queries split into pages, and
+    publishes the walls built from what the queries return.
+    """
+    opportunities, accounts, roster = salesforce_records(500)
+    fake = FakeS3()
+    cache = walls.accounts
+    with FakeSalesforce(opportunities, accounts, roster, page_size=1) as salesforce:
+        run_end_to_end(salesforce, fake, backend=backend, cpu_workers=0)
+        # the run's own account cache doesn't outlive it:
+        assert walls.accounts is cache
+        sf_accounts = salesforce.run_query(accounts_query)
+        sf_accounts = sf_accounts.rename(columns={"Id": "AccountId"})
+        sponsors = build_sponsors(sf_accounts, salesforce.run_query(sponsors_query))
+        donors = build_donors(sf_accounts, salesforce.run_query(donors_query))
+        # every REST query was read to the end, so its cursor is gone:
+        assert salesforce._cursors == {}
+
+    def published(filename):
+        return json.loads(gzip.decompress(fake.objects[filename]["Body"]))
+
+    assert sorted(fake.objects) == [
+        "business-member-roster.json",
+        "circle-members.json",
+        "donors.json",
+        "sponsors.json",
+    ]
+    assert published("donors.json") == json.loads(json.dumps(donors))
+    assert published("sponsors.json") == json.loads(json.dumps(sponsors))
+    assert published("circle-members.json") == {
+        "Editor's Circle": ["Mary 0"],
+        "Leadership Circle": ["José 50"],
+    }
+    assert sum(map(len, published("business-member-roster.json").values())) == len(
+        roster
+    )
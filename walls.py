@@ -1,49 +1,113 @@
 import json
-from time import sleep
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from functools import partial
+from time import time
 
 import requests
-import unicodecsv
-from pandas import DataFrame
+from requests.adapters import HTTPAdapter
 from salesforce_bulk import SalesforceBulk
-from simple_salesforce import Salesforce
+from salesforce_bulk.salesforce_bulk import BulkApiError
 
-from config import SALESFORCE
+from bulk import Bulk2JobManager, BulkJobManager, dtypes_for
+from compact import compact_donors, compact_sponsors
+from config import BULK, CACHE, PIPELINE, PUBLISH, SALESFORCE
 from convert import (
+    ACCOUNT_FIELDS,
+    BUSINESS_MEMBERSHIP,
+    DIGITAL_PAGES,
+    EVENT_SPONSORSHIPS,
+    LICENSING,
     _extract_and_map,
     _invert_and_aggregate,
     _sort_circle,
     _strip_sort_key,
-    convert_donors,
-    convert_sponsors,
+    build_donors,
+    build_sponsors,
+    json_chunks,
+    shard_donors,
+    shard_files,
 )
-from s3 import push_to_s3
+from pipeline import CPU, Pipeline
+from s3 import Publisher
+from search import donor_index, sponsor_index
+from store import AccountCache, OpportunitySnapshot, YearlyTotals
+
+# The record types and stages on each wall; the queries are built from
+# these, and the local filters for a combined extract use them too:
+SPONSOR_RECORD_TYPES = (
+    EVENT_SPONSORSHIPS,
+    DIGITAL_PAGES,
+    BUSINESS_MEMBERSHIP,
+    LICENSING,
+)
+SPONSOR_STAGES = ("Closed Won", "Invoiced", "Pledged")
+# Donations, Grants, and Membership:
+DONOR_RECORD_TYPES = ("01216000001IhHpAAK", "01216000001IhQIAA0", "01216000001IhI9AAK")
+DONOR_STAGES = ("Closed Won", "Pledged")
+
+# everything either wall could show:
+WALL_RECORD_TYPES = SPONSOR_RECORD_TYPES + DONOR_RECORD_TYPES
+WALL_STAGES = tuple(dict.fromkeys(SPONSOR_STAGES + DONOR_STAGES))
+
+
+def soql_list(values):
+    """
+    Quote values for a SOQL IN (...) list.
+    """
+    return ", ".join("'{}'".format(value) for value in values)
+
 
 # Events and Digital Pages, excluding Festival, and $0
 sponsors_query = """
         SELECT Id, AccountId, Amount, CloseDate, Type, RecordTypeId
         FROM Opportunity
-        WHERE RecordTypeId IN (
-            '01216000001IhmxAAC',
-            '01216000001IhIEAA0',
-            '01246000000hj93AAA',
-            '01216000001IhvaAAC'
-        )
-        AND StageName IN ('Closed Won', 'Invoiced', 'Pledged')
+        WHERE RecordTypeId IN ({})
+        AND StageName IN ({})
         AND Type != 'Earned Revenue'
         AND Amount != 0
-    """
+    """.format(soql_list(SPONSOR_RECORD_TYPES), soql_list(SPONSOR_STAGES))
 
-# Donations, Grants, and Membership:
 donors_query = """
     SELECT Id, AccountId, Amount, CloseDate
     FROM Opportunity
-    WHERE RecordTypeId IN (
-        '01216000001IhHpAAK',
-        '01216000001IhQIAA0',
-        '01216000001IhI9AAK'
+    WHERE RecordTypeId IN ({})
+    AND StageName IN ({})
+""".format(soql_list(DONOR_RECORD_TYPES), soql_list(DONOR_STAGES))
+
+# Both of the above in one extract; sponsor_opportunities() and
+# donor_opportunities() apply the rest of each query's filter locally:
+combined_query = """
+    SELECT Id, AccountId, Amount, CloseDate, Type, RecordTypeId, StageName
+    FROM Opportunity
+    WHERE RecordTypeId IN ({})
+    AND StageName IN ({})
+""".format(soql_list(WALL_RECORD_TYPES), soql_list(WALL_STAGES))
+
+accounts_query = "SELECT Id, Website, Text_For_Donor_Wall__c FROM Account"
+
+# Only the accounts the walls could show:
+accounts_semijoin_query = """
+    SELECT Id, Website, Text_For_Donor_Wall__c
+    FROM Account
+    WHERE Id IN (
+        SELECT AccountId
+        FROM Opportunity
+        WHERE RecordTypeId IN ({})
+        AND StageName IN ({})
     )
-    AND StageName IN ('Closed Won', 'Pledged')
-"""
+""".format(soql_list(WALL_RECORD_TYPES), soql_list(WALL_STAGES))
+
+changed_query = "SELECT Id FROM Opportunity WHERE {}"
+
+# Ways of getting the accounts (BULK_ACCOUNT_PUSHDOWN): pull every account
+# separately, pull their fields in with the opportunities, or pull only
+# the accounts the opportunities refer to:
+NO_PUSHDOWN = ""
+RELATIONSHIP = "relationship"
+SEMIJOIN = "semijoin"
 
 circle_query = """
     SELECT Text_For_Donor_Wall__c, Membership_Level_TT__c, Name
@@ -61,10 +125,30 @@ class SalesforceConnection(object):
     Represents a connection to Salesforce.
 
     Creating an instance will authenticate and allow queries
-    to be processed.
+    to be processed. Requests go through a pooled session so connections
+    are reused, and the access token is kept until it expires or
+    Salesforce turns it down. Use get_connection() to share one instance
+    across the whole run.
     """
 
-    def __init__(self):
+    def __init__(self, session=None):
+
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=SALESFORCE["POOL_SIZE"],
+                pool_maxsize=SALESFORCE["POOL_SIZE"],
+            )
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+        self.session = session
+        self._lock = threading.Lock()
+        self.login()
+
+    def login(self):
+        """
+        Get a new access token.
+        """
 
         payload = {
             "grant_type": "password",
@@ -74,45 +158,157 @@ class SalesforceConnection(object):
             "password": "{0}{1}".format(SALESFORCE["PASSWORD"], SALESFORCE["TOKEN"]),
         }
         token_path = "/services/oauth2/token"
-        url = "{0}://{1}{2}".format("https", SALESFORCE["HOST"], token_path)
-        # TODO: some error handling here:
-        r = requests.post(url, data=payload)
+        url = "{0}://{1}{2}".format(
+            SALESFORCE["SCHEME"], SALESFORCE["HOST"], token_path
+        )
+        r = self.session.post(url, data=payload)
+        r.raise_for_status()
         response = json.loads(r.text)
         self.instance_url = response["instance_url"]
-        access_token = response["access_token"]
+        self.access_token = response["access_token"]
+        self.logged_in_at = time()
 
         self.headers = {
-            "Authorization": "Bearer {}".format(access_token),
+            "Authorization": "Bearer {}".format(self.access_token),
             "X-PrettyPrint": "1",
         }
 
+    def _refresh(self, stale_token):
+        # only the first thread to notice a stale token logs in again:
+        with self._lock:
+            if self.access_token == stale_token:
+                self.login()
+
+    def current_token(self):
+        """
+        The access token, after logging in again if the session is too old.
+        """
+        token = self.access_token
+        if time() - self.logged_in_at > SALESFORCE["SESSION_TIMEOUT"]:
+            self._refresh(token)
+        return self.access_token
+
+    def request(self, method, path, **kwargs):
+        """
+        Send a request for a path (or full URL) on this Salesforce
+        instance, logging in again if the token has expired or is rejected.
+        """
+        token = self.current_token()
+        if not path.startswith("http"):
+            path = "{0}{1}".format(self.instance_url, path)
+        r = self.session.request(method, path, headers=self.headers, **kwargs)
+        if r.status_code == 401:
+            self._refresh(token)
+            r = self.session.request(method, path, headers=self.headers, **kwargs)
+        r.raise_for_status()
+        return r
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def bulk(self):
+        """
+        A Bulk API client that uses this connection's login.
+        """
+        return SessionBulk(self)
+
+    def iter_query(self, query, path="/services/data/v33.0/query", prefetch=True):
+        """
+        Run a SOQL query against this Salesforce instance and yield the
+        records a page at a time. With prefetch, the next page is fetched
+        in the background while the current one is being used.
+        """
+
+        def fetch(path, params=None):
+            return json.loads(self.get(path, params=params).text)
+
+        executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        try:
+            response = fetch(path, {"q": query})
+            while True:
+                if not response["done"]:
+                    next_path = response["nextRecordsUrl"]
+                    if prefetch:
+                        upcoming = executor.submit(fetch, next_path)
+                yield from response["records"]
+                if response["done"]:
+                    return
+                response = upcoming.result() if prefetch else fetch(next_path)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
     def query(self, query, path="/services/data/v33.0/query"):
         """
-        Run a SOQL query against this Salesforce instance.
+        Run a SOQL query against this Salesforce instance and return all
+        of the records.
         """
-        url = "{0}{1}".format(self.instance_url, path)
-        if query is None:
-            payload = {}
-        else:
-            payload = {"q": query}
-        # TODO: error handling:
-        r = requests.get(url, headers=self.headers, params=payload)
-        response = json.loads(r.text)
-        # recursively get the rest of the records:
-        if response["done"] is False:
-            return response["records"] + self.query(
-                query=None, path=response["nextRecordsUrl"]
-            )
-        return response["records"]
+        return list(self.iter_query(query, path=path))
+
+
+class SessionBulk(object):
+    """
+    A SalesforceBulk client that shares a SalesforceConnection's login.
+    Every call uses the connection's current token, and a call turned down
+    because the session expired logs in again and is tried once more, the
+    same as the connection's own requests.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.client = SalesforceBulk(
+            sessionId=connection.access_token, host=connection.instance_url
+        )
+
+    def __getattr__(self, name):
+        method = getattr(self.client, name)
+        if not callable(method):
+            return method
+
+        def call(*args, **kwargs):
+            token = self.connection.current_token()
+            self.client.sessionId = token
+            try:
+                return method(*args, **kwargs)
+            except BulkApiError as e:
+                if not _invalid_session(e):
+                    raise
+            self.connection._refresh(token)
+            self.client.sessionId = self.connection.access_token
+            return method(*args, **kwargs)
+
+        return call
+
+
+def _invalid_session(error):
+    # the Bulk API turns down an expired session with a 400, not a 401:
+    return error.status_code == 401 or "InvalidSessionId" in str(error)
+
+
+_connection = None
+_connection_lock = threading.Lock()
+
+
+def get_connection():
+    """
+    The Salesforce connection shared by everything in this run.
+    """
+    global _connection
+    with _connection_lock:
+        if _connection is None:
+            _connection = SalesforceConnection()
+        return _connection
 
 
 def business_roster():
 
-    sf = SalesforceConnection()
+    sf = get_connection()
 
     path = "/services/data/v43.0/analytics/reports/00O46000000hUA3"
-    url = "{}{}".format(sf.instance_url, path)
-    resp = requests.get(url, headers=sf.headers)
+    resp = sf.get(path)
     content = json.loads(resp.text)
     final = dict()
     for item in content["factMap"]["T!T"]["rows"]:
@@ -130,16 +326,15 @@ def business_roster():
 
 def generate_circle_data():
     """
-    Create a JSON file based on current circle members that
-    identifies the level of circle membership. Save this
-    file to S3.
+    Create JSON based on current circle members that
+    identifies the level of circle membership.
     """
 
     # circle wall
-    sf = SalesforceConnection()
-    response = sf.query(circle_query)
+    sf = get_connection()
+    records = sf.iter_query(circle_query)
     new_dict = _extract_and_map(
-        argument=response,
+        argument=records,
         key="Text_For_Donor_Wall__c",
         value="Membership_Level_TT__c",
         sort_key="Name",
@@ -148,8 +343,194 @@ def generate_circle_data():
     now_sorted = _sort_circle(intermediate)
     final = _strip_sort_key(now_sorted)
     json_output = json.dumps(final)
+    return json_output
+
 
-    push_to_s3(filename="circle-members.json", contents=json_output)
+_bulk_jobs = None
+_bulk_jobs_lock = threading.Lock()
+
+
+def bulk_jobs():
+    """
+    The Bulk API job manager shared by everything in this run, so all of
+    the run's query jobs are polled together. BULK_BACKEND=2.0 switches to
+    Bulk API 2.0.
+    """
+    global _bulk_jobs
+    with _bulk_jobs_lock:
+        if _bulk_jobs is None:
+            if BULK["BACKEND"] == "2.0":
+                _bulk_jobs = Bulk2JobManager(
+                    get_connection(),
+                    page_size=BULK["PAGE_SIZE"],
+                    workers=BULK["DOWNLOAD_WORKERS"],
+                )
+            else:
+                _bulk_jobs = BulkJobManager(
+                    get_connection().bulk(),
+                    download_workers=BULK["DOWNLOAD_WORKERS"],
+                )
+        return _bulk_jobs
+
+
+def _modified_after(watermark, related=()):
+    fields = ["SystemModstamp"]
+    fields.extend("{}.SystemModstamp".format(name) for name in related)
+    conditions = ["{} > {}".format(field, watermark) for field in fields]
+    if len(conditions) == 1:
+        return conditions[0]
+    return "({})".format(" OR ".join(conditions))
+
+
+def modified_since(query, watermark, related=()):
+    """
+    Narrow a query, which must already have a WHERE clause, to records
+    modified after the watermark. Records whose related objects (e.g.
+    "Account") were modified count too.
+    """
+    return "{} AND {}".format(query.rstrip(), _modified_after(watermark, related))
+
+
+def with_account_fields(query):
+    """
+    Add the Account.* fields the walls show to an Opportunity query, so
+    the accounts don't have to be fetched separately.
+    """
+    return re.sub(
+        r"\s+FROM\s+Opportunity\b",
+        lambda match: ", " + ", ".join(ACCOUNT_FIELDS) + match.group(0),
+        query,
+        count=1,
+    )
+
+
+def sponsor_opportunities(opps):
+    """
+    Pick the rows sponsors_query would have returned out of a
+    combined_query extract. Like SOQL's !=, a blank Type or Amount
+    doesn't count as a match for the exclusions.
+    """
+    keep = (
+        opps["RecordTypeId"].isin(SPONSOR_RECORD_TYPES)
+        & opps["StageName"].isin(SPONSOR_STAGES)
+        & (opps["Type"] != "Earned Revenue")
+        & (opps["Amount"] != 0)
+    )
+    return opps.loc[keep, _wall_columns(opps, sponsors_query)].reset_index(drop=True)
+
+
+def donor_opportunities(opps):
+    """
+    Pick the rows donors_query would have returned out of a combined_query
+    extract.
+    """
+    keep = opps["RecordTypeId"].isin(DONOR_RECORD_TYPES) & opps["StageName"].isin(
+        DONOR_STAGES
+    )
+    return opps.loc[keep, _wall_columns(opps, donors_query)].reset_index(drop=True)
+
+
+def _wall_columns(opps, query):
+    # plus any account fields that were pulled in with them:
+    columns = list(dtypes_for(query))
+    return columns + [field for field in ACCOUNT_FIELDS if field in opps]
+
+
+def frozen_totals(name):
+    """
+    The frozen yearly totals for a wall, if FREEZE_YEARS is on. They need
+    snapshots too, since that's how we find out which years changed.
+    """
+    if CACHE["SNAPSHOTS"] and CACHE["FREEZE_YEARS"]:
+        return YearlyTotals(CACHE["SNAPSHOTS"], name)
+    return None
+
+
+def sf_opportunities(query, snapshot_name=None, walls=None):
+    """
+    Get opportunity data using supplied query as a dataframe.
+
+    If SNAPSHOT_DB is set and a snapshot name is given, only opportunities
+    modified since the last run are pulled from Salesforce and merged into
+    a local snapshot. FULL_REFRESH=true pulls everything again. walls are
+    the walls whose frozen totals depend on the snapshot; by default it's
+    the wall of the same name.
+    """
+
+    jobs = bulk_jobs()
+    if not (snapshot_name and CACHE["SNAPSHOTS"]):
+        return jobs.submit(
+            "Opportunity", query, pk_chunking=BULK["PK_CHUNK_SIZE"]
+        ).result()
+
+    snapshot = OpportunitySnapshot(CACHE["SNAPSHOTS"], snapshot_name, query)
+    frozen = [frozen_totals(wall) for wall in walls or [snapshot_name]]
+    frozen = [totals for totals in frozen if totals is not None]
+    watermark = snapshot.watermark()
+    # back off a little so changes saved while we're extracting aren't missed
+    # next time; picking them up twice does no harm:
+    started = datetime.now(timezone.utc) - timedelta(minutes=CACHE["OVERLAP"])
+    next_watermark = started.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    if watermark is None or CACHE["FULL_REFRESH"]:
+        print("Refreshing the {} snapshot...".format(snapshot_name))
+        opps = jobs.submit(
+            "Opportunity", query, pk_chunking=BULK["PK_CHUNK_SIZE"]
+        ).result()
+        snapshot.replace(opps, next_watermark)
+        for totals in frozen:
+            totals.clear()
+        return opps
+
+    print("Updating the {} snapshot since {}...".format(snapshot_name, watermark))
+    # account fields pulled in with the opportunities go stale when the
+    # account changes, so those opportunities count as changed too:
+    related = ["Account"] if any(field in query for field in ACCOUNT_FIELDS) else []
+    # everything that changed, including deletions and opportunities that
+    # no longer match the query:
+    changed = jobs.submit(
+        "Opportunity",
+        changed_query.format(_modified_after(watermark, related)),
+        include_deleted=True,
+    )
+    # and the changes that still match:
+    updated = jobs.submit("Opportunity", modified_since(query, watermark, related))
+    touched = snapshot.merge(changed.result()["Id"], updated.result(), next_watermark)
+    for totals in frozen:
+        totals.invalidate(touched)
+
+    return snapshot.load(dtypes_for(query))
+
+
+def account_query():
+    """
+    The query for the accounts. With BULK_ACCOUNT_PUSHDOWN=semijoin only
+    accounts with opportunities on a wall are fetched.
+    """
+    if BULK["ACCOUNT_PUSHDOWN"] == SEMIJOIN:
+        return accounts_semijoin_query
+    return accounts_query
+
+
+def sf_accounts():
+    """
+    Get account data as a dataframe.
+    """
+
+    accts = bulk_jobs().submit("Account", account_query()).result()
+    accts.rename(columns={"Id": "AccountId"}, inplace=True)
+
+    return accts
+
+
+# Every wall that needs accounts shares this, so they're only fetched once
+# per run (and, if ACCOUNTS_CACHE is set, reused across runs):
+accounts = AccountCache(
+    sf_accounts,
+    path=CACHE["ACCOUNTS"],
+    max_age=CACHE["ACCOUNTS_MAX_AGE"],
+    query=account_query(),
+)
 
 
 def sf_data(query):
@@ -160,81 +541,273 @@ def sf_data(query):
     Return both as dataframes.
 
     """
+    return sf_opportunities(query), accounts.get()
 
-    USER = SALESFORCE["USERNAME"]
-    PASS = SALESFORCE["PASSWORD"]
-    TOKEN = SALESFORCE["TOKEN"]
-    HOST = SALESFORCE["HOST"]
 
-    sf = Salesforce(username=USER, password=PASS, security_token=TOKEN)
+_publisher = None
+_publisher_lock = threading.Lock()
 
-    bulk = SalesforceBulk(sessionId=sf.session_id, host=HOST)
 
-    print("Creating Opportunity job...")
-    job = bulk.create_query_job("Opportunity", contentType="CSV")
-    print("Issuing query...")
+def get_publisher():
+    """
+    The S3 publisher shared by everything in this run.
+    """
+    global _publisher
+    with _publisher_lock:
+        if _publisher is None:
+            _publisher = Publisher(
+                workers=PUBLISH["WORKERS"],
+                pool_size=PUBLISH["POOL_SIZE"],
+                max_attempts=PUBLISH["MAX_ATTEMPTS"],
+                versioned=PUBLISH["VERSIONED"],
+            )
+        return _publisher
 
-    batch = bulk.query(job, query)
-    bulk.close_job(job)
-    while not bulk.is_batch_done(batch):
-        print("waiting for query to complete...")
-        sleep(3)
 
-    rows = list()
-    for result in bulk.get_all_results_for_query_batch(batch):
-        reader = unicodecsv.DictReader(result, encoding="utf-8")
-        for row in reader:
-            rows.append(row)
+def publish(filename, contents):
+    """
+    Queue a JSON string to be published in the background.
+    """
+    return get_publisher().publish(filename, contents)
 
-    opps = DataFrame.from_dict(rows)
 
-    job = bulk.create_query_job("Account", contentType="CSV")
-    print("Creating Account job...")
+def publish_json(filename, data):
+    """
+    Queue a wall to be serialized straight into S3 a piece at a time, so
+    the whole JSON is never held in memory.
+    """
+    return get_publisher().publish_stream(filename, json_chunks(data))
 
-    batch = bulk.query(job, "SELECT Id, Website, Text_For_Donor_Wall__c FROM Account")
-    print("Issuing query...")
-    while not bulk.is_batch_done(batch):
-        print("waiting for query to complete...")
-        sleep(3)
-    bulk.close_job(job)
 
-    rows = list()
-    for result in bulk.get_all_results_for_query_batch(batch):
-        reader = unicodecsv.DictReader(result, encoding="utf-8")
-        for row in reader:
-            rows.append(row)
+def donor_shard_files(donors):
+    """
+    The donors wall split by initial and by year, with its index.
+    """
+    return shard_files(shard_donors(donors), "donors")
 
-    accts = DataFrame.from_dict(list(rows))
-    accts.rename(columns={"Id": "AccountId"}, inplace=True)
 
-    return opps, accts
+def publish_shards(shards, index_filename="donors/index.json"):
+    """
+    Publish the files donor_shard_files returns, and then, once every one
+    of them is up, the index; so the index never lists a file that isn't
+    there yet. When publishing is versioned, the index lists the files'
+    versioned names.
+    """
+    files, index = shards
+    uploads = [publish(filename, contents) for filename, contents in files.items()]
+    for upload in uploads:
+        upload.result()
+    for entry in index.values():
+        entry["file"] = get_publisher().published_name(entry["file"])
+    return publish(index_filename, json.dumps(index))
+
+
+def wall_outputs(build, derived, serialize, *args):
+    """
+    Build a wall and what's published from it: derived is a list of
+    (name, function, json) for each of those. Returns them by name, with
+    the wall itself as "wall".
+
+    This is one CPU stage so the wall is only sent between processes once,
+    if at all. With serialize, the wall and every output marked json come
+    back as JSON, since a str costs far less to send back from the
+    process pool than the dicts and lists it's made from; but then the
+    whole JSON is in memory at once, which publish_json avoids.
+    """
+    wall = build(*args)
+    outputs = {"wall": (wall, True)}
+    for name, func, is_json in derived:
+        outputs[name] = (func(wall), is_json)
+    return {
+        name: json.dumps(output) if serialize and is_json else output
+        for name, (output, is_json) in outputs.items()
+    }
+
+
+def publish_output(filename, name, outputs):
+    """
+    Queue one of the outputs of wall_outputs to be published: a str as it
+    is, anything else serialized a piece at a time as it's uploaded.
+    """
+    output = outputs[name]
+    if isinstance(output, str):
+        return publish(filename, output)
+    return publish_json(filename, output)
+
+
+def publish_donor_shards(outputs):
+    """
+    Queue the donor shards from wall_outputs to be published.
+    """
+    return publish_shards(outputs["shards"])
+
+
+def build_pipeline():
+    """
+    Lay out each wall as fetch, transform and publish stages. The walls
+    don't depend on each other so they all run at the same time.
+    """
+    pushdown = BULK["ACCOUNT_PUSHDOWN"]
+    if pushdown not in (NO_PUSHDOWN, RELATIONSHIP, SEMIJOIN):
+        raise ValueError("Unknown account pushdown: {}".format(pushdown))
+
+    pipeline = Pipeline(
+        io_workers=PIPELINE["IO_WORKERS"], cpu_workers=PIPELINE["CPU_WORKERS"]
+    )
 
+    # Circles
+    pipeline.add("circle:fetch", generate_circle_data)
+    pipeline.add(
+        "circle:publish",
+        partial(publish, "circle-members.json"),
+        requires=["circle:fetch"],
+    )
 
-# Circles
-print("Fetching Circle data...")
-generate_circle_data()
+    # Accounts, shared by sponsors and donors, unless their fields come
+    # with the opportunities; then each converter gets the accounts from
+    # its own opportunities
+    queries = {
+        "sponsors": sponsors_query,
+        "donors": donors_query,
+        "combined": combined_query,
+    }
+    if pushdown == RELATIONSHIP:
+        queries = {name: with_account_fields(q) for name, q in queries.items()}
+        with_accounts = []
+        account_arg = (None,)
+    else:
+        with_accounts = ["accounts:fetch"]
+        account_arg = ()
+        pipeline.add("accounts:fetch", accounts.get)
+
+    # Opportunities, either one extract per wall or a single one for both
+    if BULK["COMBINED"]:
+        pipeline.add(
+            "opportunities:fetch",
+            partial(
+                sf_opportunities,
+                queries["combined"],
+                "opportunities",
+                walls=["sponsors", "donors"],
+            ),
+        )
+        pipeline.add(
+            "sponsors:fetch", sponsor_opportunities, requires=["opportunities:fetch"]
+        )
+        pipeline.add(
+            "donors:fetch", donor_opportunities, requires=["opportunities:fetch"]
+        )
+    else:
+        pipeline.add(
+            "sponsors:fetch",
+            partial(sf_opportunities, queries["sponsors"], "sponsors"),
+        )
+        pipeline.add(
+            "donors:fetch", partial(sf_opportunities, queries["donors"], "donors")
+        )
 
-# Sponsors
-print("Fetching Sponsor data...")
-opps, accts = sf_data(sponsors_query)
+    # Sponsors and donors are each built, along with whatever's published
+    # from them, in a single CPU stage
+    serialize = bool(PIPELINE["CPU_WORKERS"] and PIPELINE["SERIALIZE_IN_WORKERS"])
+    sponsor_outputs = []
+    if PUBLISH["SEARCH_INDEX"]:
+        sponsor_outputs.append(("index", sponsor_index, True))
+    if PUBLISH["COMPACT"]:
+        sponsor_outputs.append(("compact", compact_sponsors, True))
+    pipeline.add(
+        "sponsors:transform",
+        partial(
+            wall_outputs,
+            partial(build_sponsors, *account_arg, frozen=frozen_totals("sponsors")),
+            sponsor_outputs,
+            serialize,
+        ),
+        requires=with_accounts + ["sponsors:fetch"],
+        kind=CPU,
+    )
+    pipeline.add(
+        "sponsors:publish",
+        partial(publish_output, "sponsors.json", "wall"),
+        requires=["sponsors:transform"],
+    )
+    if PUBLISH["SEARCH_INDEX"]:
+        pipeline.add(
+            "sponsors:index:publish",
+            partial(publish_output, "sponsors-index.json", "index"),
+            requires=["sponsors:transform"],
+        )
+    if PUBLISH["COMPACT"]:
+        pipeline.add(
+            "sponsors:compact:publish",
+            partial(publish_output, "sponsors.compact.json", "compact"),
+            requires=["sponsors:transform"],
+        )
 
-print("Transforming and exporting to JSON...")
-json_output = convert_sponsors(opportunities=opps, accounts=accts)
+    # Business memberships
+    pipeline.add("roster:fetch", business_roster)
+    pipeline.add(
+        "roster:publish",
+        partial(publish, "business-member-roster.json"),
+        requires=["roster:fetch"],
+    )
 
-print("Saving sponsors to S3...")
-push_to_s3(filename="sponsors.json", contents=json_output)
+    # Donors
+    donor_outputs = []
+    if PUBLISH["SEARCH_INDEX"]:
+        donor_outputs.append(("index", donor_index, True))
+    if PUBLISH["COMPACT"]:
+        donor_outputs.append(("compact", compact_donors, True))
+    if PUBLISH["SHARD_DONORS"]:
+        # already JSON:
+        donor_outputs.append(("shards", donor_shard_files, False))
+    pipeline.add(
+        "donors:transform",
+        partial(
+            wall_outputs,
+            partial(build_donors, *account_arg, frozen=frozen_totals("donors")),
+            donor_outputs,
+            serialize,
+        ),
+        requires=with_accounts + ["donors:fetch"],
+        kind=CPU,
+    )
+    pipeline.add(
+        "donors:publish",
+        partial(publish_output, "donors.json", "wall"),
+        requires=["donors:transform"],
+    )
+    if PUBLISH["SEARCH_INDEX"]:
+        pipeline.add(
+            "donors:index:publish",
+            partial(publish_output, "donors-index.json", "index"),
+            requires=["donors:transform"],
+        )
+    if PUBLISH["COMPACT"]:
+        pipeline.add(
+            "donors:compact:publish",
+            partial(publish_output, "donors.compact.json", "compact"),
+            requires=["donors:transform"],
+        )
+    if PUBLISH["SHARD_DONORS"]:
+        pipeline.add(
+            "donors:shard:publish",
+            publish_donor_shards,
+            requires=["donors:transform"],
+        )
 
-# Business memberships
-print("Fetching business membership data...")
-json_output = business_roster()
+    return pipeline
 
-print("Saving business roster to S3...")
-push_to_s3(filename="business-member-roster.json", contents=json_output)
 
-# Donors
-opps, accounts = sf_data(donors_query)
-print("Transforming and exporting to JSON...")
-json_output = convert_donors(opportunities=opps, accounts=accts)
+if __name__ == "__main__":
 
-print("Saving donors to S3...")
-push_to_s3(filename="donors.json", contents=json_output)
+    pipeline = build_pipeline()
+    pipeline.run()
+    # the publish stages only queue their uploads:
+    try:
+        if PUBLISH["VERSIONED"]:
+            get_publisher().publish_manifest(max_age=PUBLISH["MANIFEST_MAX_AGE"])
+        else:
+            get_publisher().wait()
+    finally:
+        pipeline.report()
+        get_publisher().report()